@@ -1,13 +1,13 @@
 ﻿import os
 import sys
 import glob
-import subprocess
 import maya.cmds as cmds
 import maya.mel as mel
 
 import Utils
 
 g_jobsPool = list()
+g_gridMakerDir = "C:\\Projects\\vfxutils\\utils"
 
 def register_jobs():
     global g_jobsPool
@@ -257,12 +257,18 @@ def vray_fumefx_setup():
 
     Utils.maya_print("Vray now using FumeFX setup.")
 
-def make_sprite_sheet():
-    cmd = "process_ffx('C:/Projects/ffx/images/ffx_d.{}.tga', (8, 4))\n"
-    subprocess.call(["C:\\Python27\\python.exe", "C:\\Projects\\vfxutils\\utils\\GridMaker.py", cmd], stdout=sys.__stdout__)
-
-def make_nm_sprite_sheet():
-    cmd  = "process_ffx('C:/Projects/ffx/images/ffx_nm_forward.{}.tga', (8, 4))\n"
-    cmd += "process_ffx('C:/Projects/ffx/images/ffx_nm_inverted.{}.tga', (8, 4))\n"
-    cmd += "combine_ffx_normals('C:/Projects/ffx/images/ffx_nm_forward.{}.tga', 'C:/Projects/ffx/images/ffx_nm_inverted.{}.tga')\n"
-    subprocess.call(["C:\\Python27\\python.exe", "C:\\Projects\\vfxutils\\utils\\GridMaker.py", cmd], stdout=sys.__stdout__)
+def grid_maker_job(job, *args, **kwargs):
+    # Runs a GridMaker job in the long-lived C:\Python27 worker (started on
+    # first use), so each click skips interpreter and PIL startup.
+    if g_gridMakerDir not in sys.path:
+        sys.path.append(g_gridMakerDir)
+    import GridWorker
+    return GridWorker.submit(job, *args, **kwargs)
+
+def make_sprite_sheet(workers=None):
+    grid_maker_job("process_ffx", "C:/Projects/ffx/images/ffx_d.{}.tga", (8, 4), workers=workers)
+
+def make_nm_sprite_sheet(workers=None):
+    sources = {"forward": "C:/Projects/ffx/images/ffx_nm_forward.{}.tga", "inverted": "C:/Projects/ffx/images/ffx_nm_inverted.{}.tga"}
+    sinks = [["NormalsSink", ["C:/Projects/ffx/images/ffx_nm_final.tga", "forward", "inverted"]]]
+    grid_maker_job("build_sheets", sources, sinks, (8, 4), workers=workers)
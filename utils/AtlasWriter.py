@@ -0,0 +1,395 @@
+import os
+import zlib
+import struct
+import numpy as np
+from PIL import Image
+
+import TgaFile
+from Profiler import Stage, add_bytes
+
+CHANNELS = {'L': 1, 'RGB': 3, 'RGBA': 4}
+
+# Compressed bytes buffered before a PNG IDAT chunk is flushed.
+PNG_CHUNK_SIZE = 1 << 20
+
+
+def frame_pixels(frame, mode):
+    # PIL image or uint8 array -> (h, w, channels) uint8 array in 'mode'.
+    # Arrays with another channel count are converted the way PIL would.
+    if not isinstance(frame, Image.Image):
+        if frame.ndim == 3 and frame.shape[2] == 1:
+            frame = frame[:, :, 0]
+        channels = frame.shape[2] if frame.ndim == 3 else 1
+        if channels == CHANNELS[mode]:
+            return frame if frame.ndim == 3 else frame[:, :, None]
+        frame = Image.fromarray(np.ascontiguousarray(frame))
+    if frame.mode != mode:
+        frame = frame.convert(mode)
+    frame = np.asarray(frame)
+    if frame.ndim == 2:
+        frame = frame[:, :, None]
+    return frame
+
+
+class TgaStreamWriter(object):
+    # Uncompressed TGA laid out exactly like PIL's writer (bottom-left origin
+    # plus v2 footer). Bands arrive top to bottom and each one is seeked to its
+    # place in the bottom-up file, so only the band itself is held in memory.
+
+    def __init__(self, fileName, size, mode='RGBA'):
+        self.fileName = fileName
+        self.size = size
+        self.mode = mode
+        self.rowBytes = size[0] * CHANNELS[mode]
+        self.rowsWritten = 0
+
+        self.file = open(fileName, 'wb')
+        self.file.write(TgaFile.make_header(size, mode))
+        self.dataOffset = self.file.tell()
+
+    def write(self, pixels):
+        with Stage("encode tga"):
+            pixels = frame_pixels(pixels, self.mode)
+            if self.mode != 'L':
+                pixels = pixels[:, :, (2, 1, 0, 3)[0:pixels.shape[2]]]
+            bottomRow = self.size[1] - self.rowsWritten - pixels.shape[0]
+            self.file.seek(self.dataOffset + bottomRow * self.rowBytes)
+            data = np.ascontiguousarray(pixels[::-1]).tobytes()
+            self.file.write(data)
+            self.rowsWritten += pixels.shape[0]
+            add_bytes(bytesWritten=len(data))
+
+    def close(self):
+        # rows never written stay zero (transparent black)
+        self.file.seek(self.dataOffset + self.size[1] * self.rowBytes)
+        self.file.truncate()
+        self.file.write(TgaFile.FOOTER)
+        self.file.close()
+
+    def abort(self):
+        # after a failed build: no padding, no partial file left behind
+        self.file.close()
+        os.remove(self.fileName)
+
+
+class PngStreamWriter(object):
+    # 8-bit PNG written band by band: rows are 'Up' filtered against the
+    # previous row and fed through one zlib stream into IDAT chunks.
+
+    def __init__(self, fileName, size, mode='RGBA', compressLevel=6):
+        self.fileName = fileName
+        self.size = size
+        self.mode = mode
+        self.rowsWritten = 0
+        self.prevRow = np.zeros((size[0] * CHANNELS[mode],), np.uint8)
+        self.compressor = zlib.compressobj(compressLevel)
+        self.pending = []
+        self.pendingSize = 0
+        self.bytesWritten = 8
+
+        colorType = {'L': 0, 'RGB': 2, 'RGBA': 6}[mode]
+        self.file = open(fileName, 'wb')
+        self.file.write(b"\x89PNG\r\n\x1a\n")
+        self.write_chunk(b"IHDR", struct.pack('>IIBBBBB', size[0], size[1], 8, colorType, 0, 0, 0))
+
+    def write_chunk(self, chunkType, data):
+        self.bytesWritten += len(data) + 12
+        self.file.write(struct.pack('>I', len(data)))
+        self.file.write(chunkType)
+        self.file.write(data)
+        self.file.write(struct.pack('>I', zlib.crc32(chunkType + data) & 0xffffffff))
+
+    def flush_idat(self, force=False):
+        if self.pendingSize >= PNG_CHUNK_SIZE or (force and self.pendingSize > 0):
+            self.write_chunk(b"IDAT", b"".join(self.pending))
+            self.pending = []
+            self.pendingSize = 0
+
+    def write(self, pixels):
+        with Stage("encode png"):
+            written = self.bytesWritten
+            pixels = frame_pixels(pixels, self.mode)
+            rows = pixels.reshape(pixels.shape[0], -1)
+
+            filtered = np.empty((rows.shape[0], rows.shape[1] + 1), np.uint8)
+            filtered[:, 0] = 2 # 'Up' filter
+            filtered[0, 1:] = rows[0] - self.prevRow
+            filtered[1:, 1:] = rows[1:] - rows[:-1]
+            self.prevRow = rows[-1].copy()
+
+            data = self.compressor.compress(filtered.tobytes())
+            if data:
+                self.pending.append(data)
+                self.pendingSize += len(data)
+                self.flush_idat()
+            self.rowsWritten += pixels.shape[0]
+            add_bytes(bytesWritten=self.bytesWritten - written)
+
+    def close(self):
+        missingRows = self.size[1] - self.rowsWritten
+        if missingRows > 0:
+            self.write(np.zeros((missingRows, self.size[0], CHANNELS[self.mode]), np.uint8))
+        with Stage("encode png"):
+            written = self.bytesWritten
+            self.pending.append(self.compressor.flush())
+            self.pendingSize += len(self.pending[-1])
+            self.flush_idat(True)
+            self.write_chunk(b"IEND", b"")
+            self.file.close()
+            add_bytes(bytesWritten=self.bytesWritten - written)
+
+    def abort(self):
+        self.file.close()
+        os.remove(self.fileName)
+
+
+# PNG colour types a PngStreamReader decodes, as PIL modes.
+PNG_COLOR_MODES = {0: 'L', 2: 'RGB', 6: 'RGBA'}
+
+
+def unfilter_png_row(filterType, row, prev, bpp):
+    # One PNG scanline with its filter undone. None/Sub/Up are vectorised;
+    # Average and Paeth (not written by PngStreamWriter) go byte by byte.
+    if filterType == 0:
+        return row
+    if filterType == 1:
+        return np.cumsum(row.reshape(-1, bpp), axis=0, dtype=np.uint8).ravel()
+    if filterType == 2:
+        return row + prev
+    if filterType not in (3, 4):
+        raise IOError("Bad PNG filter type {}".format(filterType))
+
+    out = row.tolist()
+    up = prev.tolist()
+    for i in xrange(0, len(out)):
+        left = out[i - bpp] if i >= bpp else 0
+        if filterType == 3:
+            out[i] = (out[i] + ((left + up[i]) >> 1)) & 255
+        else:
+            upLeft = up[i - bpp] if i >= bpp else 0
+            p = left + up[i] - upLeft
+            pa, pb, pc = abs(p - left), abs(p - up[i]), abs(p - upLeft)
+            predictor = left if pa <= pb and pa <= pc else (up[i] if pb <= pc else upLeft)
+            out[i] = (out[i] + predictor) & 255
+    return np.array(out, np.uint8)
+
+
+class PngStreamReader(object):
+    # 8-bit non-interlaced L/RGB/RGBA PNG decoded top to bottom: read(box)
+    # inflates only the rows up to the box, so a sheet read in bands never
+    # exists decoded as a whole. Boxes must not move back up.
+
+    def __init__(self, fileName, header):
+        self.size = (header[0], header[1])
+        self.mode = PNG_COLOR_MODES[header[3]]
+        self.bpp = CHANNELS[self.mode]
+        self.rowBytes = self.size[0] * self.bpp
+        self.file = open(fileName, 'rb')
+        self.file.seek(8)
+        self.decompressor = zlib.decompressobj()
+        self.buffer = b""
+        self.prevRow = np.zeros((self.rowBytes,), np.uint8)
+        self.nextRow = 0
+        self.idatLeft = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        self.close()
+
+    def read_idat(self):
+        # next piece of the compressed stream, b"" after the last IDAT
+        while self.idatLeft == 0:
+            length, chunkType = struct.unpack('>I4s', self.file.read(8))
+            if chunkType == b"IDAT":
+                self.idatLeft = length
+            elif chunkType == b"IEND":
+                return b""
+            else:
+                self.file.seek(length + 4, 1)
+        data = self.file.read(min(self.idatLeft, PNG_CHUNK_SIZE))
+        add_bytes(bytesRead=len(data))
+        self.idatLeft -= len(data)
+        if self.idatLeft == 0:
+            self.file.seek(4, 1) # CRC
+        return data
+
+    def read_rows(self, count):
+        rows = np.empty((count, self.rowBytes), np.uint8)
+        for i in xrange(0, count):
+            while len(self.buffer) < self.rowBytes + 1:
+                data = self.read_idat()
+                if not data:
+                    raise IOError("PNG data ends at row {}".format(self.nextRow))
+                self.buffer += self.decompressor.decompress(data)
+            line = np.frombuffer(self.buffer[0:self.rowBytes + 1], np.uint8)
+            self.buffer = self.buffer[self.rowBytes + 1:]
+            self.prevRow = rows[i] = unfilter_png_row(line[0], line[1:], self.prevRow, self.bpp)
+            self.nextRow += 1
+        return rows
+
+    def read(self, box=None):
+        left, top, right, bottom = box if box is not None else (0, 0) + self.size
+        if top < self.nextRow:
+            raise ValueError("PngStreamReader reads top to bottom, row {} is gone".format(top))
+        if top > self.nextRow:
+            self.read_rows(top - self.nextRow)
+        rows = self.read_rows(bottom - top).reshape(bottom - top, self.size[0], self.bpp)
+        pixels = rows[:, left:right]
+        return pixels if self.mode != 'L' else pixels[:, :, 0]
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+def open_png_stream(fileName):
+    # PngStreamReader for a PNG it can decode, None otherwise.
+    with open(fileName, 'rb') as f:
+        head = f.read(33)
+    if len(head) < 33 or head[0:8] != b"\x89PNG\r\n\x1a\n" or head[12:16] != b"IHDR":
+        return None
+    header = struct.unpack('>IIBBBBB', head[16:29])
+    width, height, bitDepth, colorType, compression, filterMethod, interlace = header
+    if bitDepth != 8 or colorType not in PNG_COLOR_MODES or interlace != 0:
+        return None
+    return PngStreamReader(fileName, (width, height, bitDepth, colorType))
+
+
+class ImageBufferWriter(object):
+    # Fallback for formats without a streaming writer: collects the bands in
+    # one PIL image and saves it on close.
+
+    def __init__(self, fileName, size, mode='RGBA'):
+        self.fileName = fileName
+        self.mode = mode
+        self.image = Image.new(mode, size)
+        self.rowsWritten = 0
+
+    def write(self, pixels):
+        pixels = frame_pixels(pixels, self.mode)
+        if self.mode == 'L':
+            pixels = pixels[:, :, 0]
+        self.image.paste(Image.fromarray(np.ascontiguousarray(pixels), self.mode), (0, self.rowsWritten))
+        self.rowsWritten += pixels.shape[0]
+
+    def close(self):
+        with Stage("encode image"):
+            self.image.save(self.fileName)
+            add_bytes(bytesWritten=os.path.getsize(self.fileName))
+
+    def abort(self):
+        self.image = None
+
+
+def open_image_writer(fileName, size, mode='RGBA'):
+    ext = os.path.splitext(fileName)[1].lower()
+    if ext == '.tga':
+        return TgaStreamWriter(fileName, size, mode)
+    if ext == '.png':
+        return PngStreamWriter(fileName, size, mode)
+    return ImageBufferWriter(fileName, size, mode)
+
+
+class AtlasWriter(object):
+    # Fills a gridSize atlas of frameSize cells in row-major order and encodes
+    # each grid row as soon as it is complete. Peak memory is one row of cells.
+    # rowFilter(pixels) may modify a finished (frameH, atlasW, c) row in place.
+
+    def __init__(self, fileName, frameSize, gridSize, mode='RGBA', rowFilter=None):
+        self.frameSize = tuple(frameSize)
+        self.gridSize = tuple(gridSize)
+        self.mode = mode
+        self.rowFilter = rowFilter
+        self.size = (gridSize[0] * frameSize[0], gridSize[1] * frameSize[1])
+        self.row = np.zeros((frameSize[1], self.size[0], CHANNELS[mode]), np.uint8)
+        self.cell = 0
+        self.gridRow = 0
+        self.writer = open_image_writer(fileName, self.size, mode)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        if excType is not None:
+            self.abort()
+        else:
+            self.close()
+
+    def paste(self, frame):
+        # Frames smaller than the cell go to its top-left corner, like Image.paste().
+        if self.gridRow >= self.gridSize[1]:
+            raise ValueError("Atlas grid {}x{} is already full".format(*self.gridSize))
+        with Stage("paste"):
+            pixels = frame_pixels(frame, self.mode)
+            left = self.cell * self.frameSize[0]
+            self.row[0:pixels.shape[0], left:left + pixels.shape[1]] = pixels
+        self.cell += 1
+        if self.cell >= self.gridSize[0]:
+            self.flush_row()
+
+    def flush_row(self):
+        if self.rowFilter is not None:
+            self.rowFilter(self.row)
+        self.writer.write(self.row)
+        self.row[...] = 0
+        self.cell = 0
+        self.gridRow += 1
+
+    def close(self):
+        if self.writer is None:
+            return
+        if self.cell > 0:
+            self.flush_row()
+        while self.gridRow < self.gridSize[1]:
+            self.flush_row()
+        self.writer.close()
+        self.writer = None
+
+    def abort(self):
+        # Drops a partly built atlas instead of padding it into a valid file.
+        if self.writer is None:
+            return
+        self.writer.abort()
+        self.writer = None
+
+
+class CanvasWriter(object):
+    # Random-access atlas kept in memory for formats that can't be mapped;
+    # saved through PIL on close.
+
+    def __init__(self, fileName, size, mode='RGBA'):
+        self.fileName = fileName
+        self.size = size
+        self.mode = mode
+        self.pixels = np.zeros((size[1], size[0], CHANNELS[mode]), np.uint8)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        if excType is not None:
+            self.pixels = None
+        self.close()
+
+    def write(self, pixels, location=(0, 0)):
+        pixels = frame_pixels(pixels, self.mode)
+        left, top = location
+        self.pixels[top:top + pixels.shape[0], left:left + pixels.shape[1]] = pixels
+
+    def close(self):
+        if self.pixels is None:
+            return
+        pixels = self.pixels[:, :, 0] if self.mode == 'L' else self.pixels
+        Image.fromarray(pixels, self.mode).save(self.fileName)
+        self.pixels = None
+
+
+def open_canvas(fileName, size, mode='RGBA'):
+    # Random-access atlas: a pre-sized mapped TGA when possible, otherwise
+    # an in-memory canvas. Both take write(pixels, location) and close().
+    if os.path.splitext(fileName)[1].lower() == '.tga':
+        return TgaFile.create_tga(fileName, size, mode)
+    return CanvasWriter(fileName, size, mode)
@@ -0,0 +1,295 @@
+import os
+import sys
+import json
+import time
+import inspect
+import traceback
+import multiprocessing
+
+try:
+    from multiprocessing import SimpleQueue
+except ImportError:
+    from multiprocessing.queues import SimpleQueue
+
+import GridMaker
+import GridWorker
+import Profiler
+
+# Batch manifest: many sheet jobs in one file, run concurrently.
+#
+# {
+#   "version": 1,
+#   "defaults": {"gridSize": [8, 4]},
+#   "jobs": [
+#     {"name": "smoke", "job": "process_ffx", "fileMask": "C:/ffx/smoke.{}.tga", "smoothBorders": true},
+#     {"job": "build_sheets", "sources": {"fwd": "C:/ffx/nm_fwd.{}.tga", "inv": "C:/ffx/nm_inv.{}.tga"},
+#      "sinks": [["NormalsSink", ["C:/ffx/nm.tga", "fwd", "inv"]]]},
+#     {"job": "compress_sheet", "srcFile": "C:/ffx/smoke.combined.tga", "after": ["smoke"]}
+#   ]
+# }
+#
+# 'job' is any GridWorker.JOBS function and the other keys are its keyword
+# arguments ('args' gives positional ones). 'defaults' apply to every job
+# whose function takes them. 'after' lists jobs that must finish first.
+# TOML manifests need the 'toml' package.
+
+MANIFEST_VERSION = 1
+
+# Job keys that aren't function arguments.
+RESERVED_KEYS = ('name', 'job', 'after', 'args')
+
+# How often run_manifest() checks on pool jobs, in seconds.
+POLL_SECONDS = 0.2
+
+# In pool processes: where run_manifest_job() reports (name, pid, start time)
+# so the scheduler can tell a job whose process died from a slow one.
+g_startedQueue = None
+
+
+def load_manifest(fileName):
+    ext = os.path.splitext(fileName)[1].lower()
+    if ext == '.toml':
+        try:
+            import toml
+        except ImportError:
+            raise ValueError("{}: TOML manifests need the 'toml' package, or use JSON".format(fileName))
+        with open(fileName) as f:
+            return toml.load(f)
+    with open(fileName) as f:
+        return json.load(f)
+
+
+def job_function_args(job):
+    # (argument names, names without defaults, {name: default}) of a job
+    spec = inspect.getargspec(getattr(GridMaker, job))
+    defaults = spec.defaults or ()
+    required = spec.args[0:len(spec.args) - len(defaults)]
+    return spec.args, required, dict(zip(spec.args[len(required):], defaults))
+
+
+def plain_value(value):
+    # Manifest values with unicode strings turned into str on Python 2
+    if isinstance(value, list):
+        return [plain_value(v) for v in value]
+    if isinstance(value, dict):
+        return dict((plain_value(k), plain_value(v)) for k, v in value.items())
+    if sys.version_info[0] < 3 and isinstance(value, unicode):
+        return value.encode('utf-8')
+    return value
+
+
+def validate_manifest(manifest, concurrent=True):
+    # Manifest dict -> list of {'name', 'job', 'args', 'kwargs', 'after'}
+    # in file order. Every problem is collected and raised as one ValueError.
+    errors = []
+    if not isinstance(manifest, dict) or not isinstance(manifest.get('jobs'), list):
+        raise ValueError("Manifest needs a 'jobs' list")
+    if manifest.get('version', MANIFEST_VERSION) != MANIFEST_VERSION:
+        errors.append("unsupported version {}".format(manifest.get('version')))
+
+    defaults = plain_value(manifest.get('defaults', {}))
+    jobs = []
+    names = set()
+    for index, entry in enumerate(manifest['jobs']):
+        entry = plain_value(entry)
+        where = "job {}".format(index)
+        if not isinstance(entry, dict) or entry.get('job') not in GridWorker.JOBS:
+            errors.append("{}: 'job' must be one of {}".format(where, ", ".join(GridWorker.JOBS)))
+            continue
+
+        name = entry.get('name', "{}#{}".format(entry['job'], index))
+        where = "job '{}'".format(name)
+        if name in names:
+            errors.append("{}: duplicate name".format(where))
+        names.add(name)
+
+        argNames, required, argDefaults = job_function_args(entry['job'])
+        args = list(entry.get('args', ()))
+        kwargs = dict((k, v) for k, v in defaults.items() if k in argNames)
+        kwargs.update((k, v) for k, v in entry.items() if k not in RESERVED_KEYS)
+        for key in kwargs:
+            if key not in argNames:
+                errors.append("{}: {}() has no argument '{}'".format(where, entry['job'], key))
+        for key in required[len(args):]:
+            if key not in kwargs:
+                errors.append("{}: missing '{}'".format(where, key))
+        for key, value in kwargs.items():
+            if key.endswith('Size') and isinstance(value, list):
+                kwargs[key] = tuple(value)
+
+        if concurrent and 'workers' in argNames:
+            # jobs already run in pool processes, which can't start their own;
+            # every job function that can start a process pool takes poolType
+            kwargs.setdefault('workers', 1)
+            poolType = kwargs.get('poolType', argDefaults.get('poolType', 'thread'))
+            if kwargs['workers'] != 1 and poolType == 'process':
+                errors.append("{}: process pools can't nest, use poolType 'thread' or run with --jobs 1".format(where))
+
+        jobs.append({'name': name, 'job': entry['job'], 'args': args, 'kwargs': kwargs,
+                     'after': list(entry.get('after', ()))})
+
+    for job in jobs:
+        for dep in job['after']:
+            if dep not in names:
+                errors.append("job '{}': 'after' names unknown job '{}'".format(job['name'], dep))
+
+    if not errors:
+        # a valid order must exist
+        done = set()
+        remaining = list(jobs)
+        while remaining:
+            ready = [job for job in remaining if all(dep in done for dep in job['after'])]
+            if not ready:
+                errors.append("dependency cycle between {}".format(", ".join(job['name'] for job in remaining)))
+                break
+            done.update(job['name'] for job in ready)
+            remaining = [job for job in remaining if job['name'] not in done]
+
+    if errors:
+        raise ValueError("Invalid manifest:\n\t" + "\n\t".join(errors))
+    return jobs
+
+
+def set_started_queue(startedQueue):
+    global g_startedQueue
+    g_startedQueue = startedQueue
+
+
+def run_manifest_job(job, profile=False):
+    # Runs in a pool process; never raises so the scheduler always hears back,
+    # unless the process itself dies (see wait_results()).
+    # With 'profile' a pool process records its own stages and returns them.
+    if g_startedQueue is not None:
+        g_startedQueue.put((job['name'], os.getpid(), time.time()))
+    ownProfile = Profiler.start_profile(job['name']) if profile and Profiler.active_profile() is None else None
+    startTime = time.time()
+    try:
+        GridWorker.run_job(GridMaker, {'job': job['job'], 'args': job['args'], 'kwargs': job['kwargs']})
+        error = None
+    except Exception:
+        error = traceback.format_exc()
+    seconds = time.time() - startTime
+
+    if ownProfile is None:
+        return job['name'], error, seconds, None
+    Profiler.stop_profile()
+    return job['name'], error, seconds, (ownProfile.events, ownProfile.threadNames)
+
+
+def wait_results(pool, results, started, startedQueue):
+    # Blocks until at least one pool job is over and returns the outcomes of
+    # those that are, as run_manifest_job() does. A job whose process exited
+    # without answering (killed for memory, crashed) comes back as failed;
+    # the pool replaces the process but would never deliver the result.
+    while True:
+        while not startedQueue.empty():
+            name, pid, startTime = startedQueue.get()
+            started[name] = (pid, startTime)
+
+        outcomes = [results.pop(name).get() for name in [name for name, result in results.items() if result.ready()]]
+        if outcomes:
+            return outcomes
+
+        alive = set(process.pid for process in pool._pool if process.exitcode is None)
+        for name, result in list(results.items()):
+            if name not in started or started[name][0] in alive:
+                continue
+            # the result may still be on its way from before the exit
+            result.wait(POLL_SECONDS)
+            if result.ready():
+                outcomes.append(results.pop(name).get())
+            else:
+                del results[name]
+                pid, startTime = started[name]
+                outcomes.append((name, "pool process {} exited without a result\n".format(pid),
+                                 time.time() - startTime, None))
+        if outcomes:
+            return outcomes
+        time.sleep(POLL_SECONDS)
+
+
+def run_manifest(fileName, jobCount=None, dryRun=False, profile=None):
+    # Validates the manifest, then runs its jobs jobCount at a time (all
+    # cores by default), each as soon as its 'after' jobs have finished.
+    # 'profile' is a base path for a Profiler report of the whole run.
+    # Returns the number of jobs that failed or were skipped.
+    if jobCount is None:
+        jobCount = multiprocessing.cpu_count()
+    jobs = validate_manifest(load_manifest(fileName), jobCount > 1)
+
+    if dryRun:
+        for job in jobs:
+            print("{}: {}({})".format(job['name'], job['job'], ", ".join(
+                [repr(a) for a in job['args']] + ["{}={!r}".format(k, v) for k, v in sorted(job['kwargs'].items())])))
+        return 0
+
+    if profile is not None:
+        Profiler.start_profile(os.path.basename(fileName))
+    startTime = time.time()
+    pending = list(jobs)
+    done = set()
+    failed = set()
+    running = 0
+    outcomes = []
+    results = {}
+    started = {}
+
+    pool = startedQueue = None
+    if jobCount > 1:
+        startedQueue = SimpleQueue()
+        pool = multiprocessing.Pool(jobCount, set_started_queue, (startedQueue,))
+    try:
+        while pending or running:
+            for job in [job for job in pending if all(dep in done for dep in job['after'])]:
+                pending.remove(job)
+                if pool is None:
+                    outcomes.append(run_manifest_job(job))
+                else:
+                    results[job['name']] = pool.apply_async(run_manifest_job, (job, profile is not None))
+                running += 1
+
+            for job in [job for job in pending if any(dep in failed for dep in job['after'])]:
+                pending.remove(job)
+                failed.add(job['name'])
+                print("[{}] skipped, a job it depends on failed".format(job['name']))
+
+            if not running:
+                continue
+            if not outcomes:
+                outcomes.extend(wait_results(pool, results, started, startedQueue))
+            name, error, seconds, stages = outcomes.pop(0)
+            running -= 1
+            if stages is not None:
+                Profiler.active_profile().extend(*stages)
+            if error is None:
+                done.add(name)
+                print("[{}] done in {:.2f}s".format(name, seconds))
+            else:
+                failed.add(name)
+                print("[{}] failed after {:.2f}s:\n{}".format(name, seconds, error))
+    finally:
+        if pool is not None:
+            # a lost job stays in the pool's cache and close() would wait for it
+            if pool._cache:
+                pool.terminate()
+            else:
+                pool.close()
+            pool.join()
+
+    print("{}: {} of {} jobs done in {:.2f}s".format(os.path.basename(fileName), len(done), len(jobs), time.time() - startTime))
+    if profile is not None:
+        print_profile(Profiler.stop_profile().write(profile))
+        print("Profile: {0}.json, {0}.trace.json".format(profile))
+    return len(failed)
+
+
+def print_profile(summary):
+    # Stage table, slowest first. Nested stages also count in their parents.
+    print("{:<20} {:>6} {:>9} {:>9} {:>10} {:>10} {:>9}".format(
+        "stage", "count", "wall s", "cpu s", "read MB", "write MB", "rss+ MB"))
+    for name, stage in sorted(summary['stages'].items(), key=lambda item: -item[1]['wallSeconds']):
+        print("{:<20} {:>6} {:>9.3f} {:>9.3f} {:>10.1f} {:>10.1f} {:>9.1f}".format(
+            name, stage['count'], stage['wallSeconds'], stage['cpuSeconds'], stage['bytesRead'] / 1048576.0,
+            stage['bytesWritten'] / 1048576.0, stage['rssGrowth'] / 1048576.0))
+    print("peak RSS {:.1f} MB, {:.1f} MB of it reached during this run".format(
+        summary['peakRss'] / 1048576.0, summary['peakRssGrowth'] / 1048576.0))
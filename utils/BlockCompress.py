@@ -0,0 +1,195 @@
+import numpy as np
+
+# Image mode each format is encoded from (BC5 takes R and G).
+SOURCE_MODES = {'BC1': 'RGB', 'BC3': 'RGBA', 'BC4': 'L', 'BC5': 'RGB'}
+
+# quality -> (principal axis endpoints, least squares refinement passes)
+QUALITY_LEVELS = {
+    'fast': (False, 0),
+    'normal': (True, 1),
+    'high': (True, 3),
+}
+
+# Palette weight of the first endpoint per index, in hardware index order.
+BC1_WEIGHTS = np.float32((1.0, 0.0, 2.0 / 3.0, 1.0 / 3.0))
+BC4_WEIGHTS = np.float32((1.0, 0.0) + tuple((7.0 - k) / 7.0 for k in xrange(1, 7)))
+
+
+def image_blocks(pixels):
+    # (H, W, c) uint8 -> (blocks, 16, c) float32 in row-major block order;
+    # partial blocks at the right/bottom edge repeat the last texels.
+    if pixels.ndim == 2:
+        pixels = pixels[:, :, None]
+    padH, padW = -pixels.shape[0] % 4, -pixels.shape[1] % 4
+    if padH or padW:
+        pixels = np.pad(pixels, ((0, padH), (0, padW), (0, 0)), 'edge')
+    h, w, c = pixels.shape
+    blocks = pixels.reshape(h // 4, 4, w // 4, 4, c).swapaxes(1, 2)
+    return blocks.reshape(-1, 16, c).astype(np.float32)
+
+
+def fit_endpoints(blocks, indices, weights, e0, e1):
+    # Least squares endpoints for fixed indices: each texel is
+    # w * e0 + (1 - w) * e1. Blocks with a singular system keep e0/e1.
+    a = weights[indices]
+    b = 1.0 - a
+    aa = (a * a).sum(axis=1)
+    ab = (a * b).sum(axis=1)
+    bb = (b * b).sum(axis=1)
+    ax = np.einsum('nk,nkc->nc', a, blocks)
+    bx = np.einsum('nk,nkc->nc', b, blocks)
+
+    det = aa * bb - ab * ab
+    valid = np.abs(det) > 1e-6
+    inv = np.where(valid, 1.0 / np.where(valid, det, 1.0), 0.0)[:, None]
+    fit0 = (ax * bb[:, None] - bx * ab[:, None]) * inv
+    fit1 = (bx * aa[:, None] - ax * ab[:, None]) * inv
+    return np.where(valid[:, None], fit0, e0), np.where(valid[:, None], fit1, e1)
+
+
+def closest_indices(blocks, palette):
+    # (n, 16, c) texels vs (n, k, c) palette -> indices and per block error.
+    # A running minimum over the k entries keeps every temporary (n, 16).
+    indices = np.zeros(blocks.shape[0:2], np.intp)
+    best = None
+    for entry in xrange(0, palette.shape[1]):
+        diff = blocks - palette[:, entry:entry + 1, :]
+        dist = np.einsum('nkc,nkc->nk', diff, diff)
+        if best is None:
+            best = dist
+        else:
+            closer = dist < best
+            indices[closer] = entry
+            np.minimum(best, dist, out=best)
+    return indices, best.sum(axis=1)
+
+
+def pack_565(colors):
+    c = np.clip(colors, 0.0, 255.0)
+    r = np.round(c[:, 0] * (31.0 / 255.0)).astype(np.uint16)
+    g = np.round(c[:, 1] * (63.0 / 255.0)).astype(np.uint16)
+    b = np.round(c[:, 2] * (31.0 / 255.0)).astype(np.uint16)
+    return (r << 11) | (g << 5) | b
+
+
+def expand_565(packed):
+    r = (packed >> 11) & 31
+    g = (packed >> 5) & 63
+    b = packed & 31
+    return np.stack([(r << 3) | (r >> 2), (g << 2) | (g >> 4), (b << 3) | (b >> 2)], axis=1).astype(np.float32)
+
+
+def color_endpoints(blocks, principalAxis):
+    # Initial (e0, e1) per block: the extremes along the principal axis, or
+    # the bounding box with its diagonal flipped to follow the colour trend.
+    mean = blocks.mean(axis=1)
+    centered = blocks - mean[:, None, :]
+    cov = np.matmul(centered.transpose(0, 2, 1), centered)
+    # covariance row of the channel that varies most
+    pivot = cov[np.arange(len(cov)), np.argmax(np.diagonal(cov, axis1=1, axis2=2), axis=1)]
+
+    if principalAxis:
+        axis = pivot
+        for i in xrange(0, 8):
+            axis = np.einsum('nij,nj->ni', cov, axis)
+            axis /= np.maximum(np.abs(axis).max(axis=1, keepdims=True), 1e-6)
+        flat = np.abs(axis).max(axis=1) < 1e-6
+        axis[flat] = 1.0
+        axis /= np.sqrt((axis * axis).sum(axis=1, keepdims=True))
+        t = np.einsum('nkc,nc->nk', centered, axis)
+        e0 = mean + axis * t.max(axis=1)[:, None]
+        e1 = mean + axis * t.min(axis=1)[:, None]
+    else:
+        e0 = blocks.max(axis=1)
+        e1 = blocks.min(axis=1)
+        trend = pivot < 0.0
+        e0[trend], e1[trend] = e1[trend], e0[trend]
+
+    # inset by 1/16 of the range, the palette ends are rarely worth hitting
+    inset = (e0 - e1) * np.float32(1.0 / 16.0)
+    return e0 - inset, e1 + inset
+
+
+def encode_bc1(blocks, quality='normal'):
+    # (n, 16, 3) float RGB -> (n, 8) uint8 opaque four colour blocks.
+    principalAxis, passes = QUALITY_LEVELS[quality]
+    e0, e1 = color_endpoints(blocks, principalAxis)
+
+    best = None
+    for i in xrange(0, passes + 1):
+        p0, p1 = pack_565(e0), pack_565(e1)
+        # four colour mode needs color0 > color1
+        swap = p0 < p1
+        p0, p1 = np.where(swap, p1, p0), np.where(swap, p0, p1)
+        c0, c1 = expand_565(p0), expand_565(p1)
+        palette = BC1_WEIGHTS[None, :, None] * c0[:, None, :] + (1.0 - BC1_WEIGHTS)[None, :, None] * c1[:, None, :]
+        indices, error = closest_indices(blocks, palette)
+        indices[p0 == p1] = 0
+
+        if best is None:
+            best = [p0, p1, indices, error]
+        else:
+            better = error < best[3]
+            best = [np.where(better, p0, best[0]), np.where(better, p1, best[1]),
+                    np.where(better[:, None], indices, best[2]), np.minimum(error, best[3])]
+        if i < passes:
+            e0, e1 = fit_endpoints(blocks, indices, BC1_WEIGHTS, c0, c1)
+
+    p0, p1, indices = best[0:3]
+    out = np.empty(len(blocks), [('color0', '<u2'), ('color1', '<u2'), ('indices', '<u4')])
+    out['color0'] = p0
+    out['color1'] = p1
+    out['indices'] = (indices.astype(np.uint32) << (2 * np.arange(16, dtype=np.uint32))).sum(axis=1, dtype=np.uint32)
+    return out.view(np.uint8).reshape(-1, 8)
+
+
+def encode_bc4(blocks, quality='normal'):
+    # (n, 16) float single channel -> (n, 8) uint8 eight value blocks.
+    passes = QUALITY_LEVELS[quality][1]
+    e0 = blocks.max(axis=1)[:, None]
+    e1 = blocks.min(axis=1)[:, None]
+    values = blocks[:, :, None]
+
+    best = None
+    for i in xrange(0, passes + 1):
+        q0 = np.clip(np.round(e0), 0.0, 255.0)
+        q1 = np.clip(np.round(e1), 0.0, 255.0)
+        # eight value mode needs red0 > red1
+        q0, q1 = np.maximum(q0, q1), np.minimum(q0, q1)
+        palette = BC4_WEIGHTS[None, :, None] * q0[:, None, :] + (1.0 - BC4_WEIGHTS)[None, :, None] * q1[:, None, :]
+        indices, error = closest_indices(values, palette)
+        indices[q0[:, 0] == q1[:, 0]] = 0
+
+        if best is None:
+            best = [q0, q1, indices, error]
+        else:
+            better = error < best[3]
+            best = [np.where(better[:, None], q0, best[0]), np.where(better[:, None], q1, best[1]),
+                    np.where(better[:, None], indices, best[2]), np.minimum(error, best[3])]
+        if i < passes:
+            e0, e1 = fit_endpoints(values, indices, BC4_WEIGHTS, q0, q1)
+
+    q0, q1, indices = best[0:3]
+    bits = (indices.astype(np.uint64) << (3 * np.arange(16, dtype=np.uint64))).sum(axis=1, dtype=np.uint64)
+    out = np.empty((len(blocks), 8), np.uint8)
+    out[:, 0] = q0[:, 0]
+    out[:, 1] = q1[:, 0]
+    out[:, 2:8] = bits.astype('<u8').view(np.uint8).reshape(-1, 8)[:, 0:6]
+    return out
+
+
+def encode_blocks(pixels, format, quality='normal'):
+    # (H, W, c) uint8 in SOURCE_MODES[format] -> encoded blocks as bytes, in
+    # DDS order. Bands fed one after another must be multiples of 4 rows.
+    blocks = image_blocks(pixels)
+    if format == 'BC1':
+        out = encode_bc1(blocks[:, :, 0:3], quality)
+    elif format == 'BC3':
+        out = np.concatenate((encode_bc4(blocks[:, :, 3], quality), encode_bc1(blocks[:, :, 0:3], quality)), axis=1)
+    elif format == 'BC4':
+        out = encode_bc4(blocks[:, :, 0], quality)
+    elif format == 'BC5':
+        out = np.concatenate((encode_bc4(blocks[:, :, 0], quality), encode_bc4(blocks[:, :, 1], quality)), axis=1)
+    else:
+        raise ValueError("Unknown block format '{}'".format(format))
+    return out.tobytes()
@@ -0,0 +1,70 @@
+import os
+import struct
+
+from Profiler import Stage, add_bytes
+
+MAGIC = b"DDS "
+HEADER_SIZE = 124
+
+# Legacy FourCCs, understood by every DDS reader we care about.
+FOURCC = {'BC1': b"DXT1", 'BC3': b"DXT5", 'BC4': b"ATI1", 'BC5': b"ATI2"}
+BLOCK_BYTES = {'BC1': 8, 'BC3': 16, 'BC4': 8, 'BC5': 16}
+
+DDSD_CAPS = 0x1
+DDSD_HEIGHT = 0x2
+DDSD_WIDTH = 0x4
+DDSD_PIXELFORMAT = 0x1000
+DDSD_MIPMAPCOUNT = 0x20000
+DDSD_LINEARSIZE = 0x80000
+DDPF_FOURCC = 0x4
+DDSCAPS_COMPLEX = 0x8
+DDSCAPS_TEXTURE = 0x1000
+DDSCAPS_MIPMAP = 0x400000
+
+
+def level_size(size, format):
+    # Bytes of one mip level: 4x4 blocks, partial blocks rounded up.
+    return max(1, (size[0] + 3) // 4) * max(1, (size[1] + 3) // 4) * BLOCK_BYTES[format]
+
+
+def make_header(size, format, mipCount=1):
+    flags = DDSD_CAPS | DDSD_HEIGHT | DDSD_WIDTH | DDSD_PIXELFORMAT | DDSD_LINEARSIZE
+    caps = DDSCAPS_TEXTURE
+    if mipCount > 1:
+        flags |= DDSD_MIPMAPCOUNT
+        caps |= DDSCAPS_COMPLEX | DDSCAPS_MIPMAP
+
+    pixelFormat = struct.pack('<II4sIIIII', 32, DDPF_FOURCC, FOURCC[format], 0, 0, 0, 0, 0)
+    return (MAGIC +
+            struct.pack('<IIIIIII', HEADER_SIZE, flags, size[1], size[0], level_size(size, format), 0, mipCount) +
+            b"\000" * 44 + pixelFormat +
+            struct.pack('<IIIII', caps, 0, 0, 0, 0))
+
+
+class DdsStreamWriter(object):
+    # Block compressed DDS written in file order: level 0 top to bottom, then
+    # the smaller levels. write() takes encoded block rows as bytes.
+
+    def __init__(self, fileName, size, format, mipCount=1):
+        self.fileName = fileName
+        self.file = open(fileName, 'wb')
+        self.file.write(make_header(size, format, mipCount))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        self.close()
+        if excType is not None:
+            # a DDS missing blocks would still load; don't leave one behind
+            os.remove(self.fileName)
+
+    def write(self, data):
+        with Stage("write dds"):
+            self.file.write(data)
+            add_bytes(bytesWritten=len(data))
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
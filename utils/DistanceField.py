@@ -0,0 +1,61 @@
+import numpy as np
+
+
+def distance_rows(f):
+    # 1D squared distance transform of every row of 'f' (Felzenszwalb and
+    # Huttenlocher): d(q) = min over p of (q - p)^2 + f(p), from the lower
+    # envelope of the parabolas rooted at each p. Linear in the row length;
+    # the rows advance together, so the Python loops only run over columns.
+    rowCount, n = f.shape
+    rows = np.arange(rowCount)
+    cols = np.arange(n, dtype=np.float64)
+
+    envelope = np.zeros((rowCount, n), np.intp) # parabola roots
+    bounds = np.empty((rowCount, n + 1))         # where each one takes over
+    bounds[:, 0] = -np.inf
+    bounds[:, 1] = np.inf
+    k = np.zeros(rowCount, np.intp)
+    rooted = f + cols * cols
+
+    for q in xrange(1, n):
+        while True:
+            root = envelope[rows, k]
+            s = (rooted[:, q] - rooted[rows, root]) / (2.0 * (q - root))
+            hidden = s <= bounds[rows, k]
+            if not hidden.any():
+                break
+            k -= hidden
+        k += 1
+        envelope[rows, k] = q
+        bounds[rows, k] = s
+        bounds[rows, k + 1] = np.inf
+
+    out = np.empty(f.shape)
+    k[:] = 0
+    for q in xrange(0, n):
+        while True:
+            ahead = bounds[rows, k + 1] < q
+            if not ahead.any():
+                break
+            k += ahead
+        root = envelope[rows, k]
+        out[:, q] = (q - root) ** 2 + f[rows, root]
+    return out
+
+
+def distance_transform(sites):
+    # Exact squared Euclidean distance from every texel to the nearest True
+    # texel of the 2D mask: columns first, then rows. Without any site the
+    # result is larger than any distance inside the image.
+    far = float(sites.shape[0] ** 2 + sites.shape[1] ** 2 + 1)
+    f = np.where(sites, 0.0, far)
+    f = distance_rows(f.T).T
+    return distance_rows(f)
+
+
+def signed_distance(inside):
+    # Signed distance in texels to the silhouette edge, negative inside; the
+    # edge sits half way between an inside and an outside texel.
+    outside = np.sqrt(distance_transform(inside))
+    inner = np.sqrt(distance_transform(~inside))
+    return np.where(inside, 0.5 - inner, outside - 0.5).astype(np.float32)
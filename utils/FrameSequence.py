@@ -0,0 +1,152 @@
+import os
+import re
+import threading
+import collections
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+# (directory, prefix, suffix) -> (mtime, sequences). Adding or removing a
+# file changes the directory's mtime, so a stale listing is never reused.
+g_scanCache = {}
+g_scanCacheLock = threading.Lock()
+
+
+class FrameSequence(object):
+    # Numbered frames on disk: directory/prefix + zero padded number + suffix
+    # (the rest of the name, e.g. '.tga' or '_n.tga'). 'fileMask' is the same
+    # name with '{}' for the number, as GridMaker used before, so outputs are
+    # still fileMask.format("combined") etc.
+
+    def __init__(self, directory, prefix, padding, suffix, frames):
+        self.directory = directory
+        self.prefix = prefix
+        self.padding = padding
+        self.suffix = suffix
+        self.frames = tuple(sorted(frames))
+        self.fileMask = os.path.join(directory, prefix + "{}" + suffix)
+
+    def __len__(self):
+        return len(self.frames)
+
+    def __repr__(self):
+        return "FrameSequence({}, {}-{}, {} missing)".format(
+            self.fileMask.format("#" * self.padding), self.first(), self.last(), len(self.missing_frames()))
+
+    def first(self):
+        return self.frames[0]
+
+    def last(self):
+        return self.frames[-1]
+
+    def file_name(self, frame):
+        return self.fileMask.format(str(frame).zfill(self.padding))
+
+    def output_name(self, tag):
+        return self.fileMask.format(tag)
+
+    def missing_frames(self):
+        # gaps between the first and the last frame
+        present = set(self.frames)
+        return [frame for frame in xrange(self.first(), self.last() + 1) if frame not in present]
+
+    def run_length(self, start=None):
+        # number of consecutive frames from 'start' (the first frame by default)
+        present = set(self.frames)
+        frame = self.first() if start is None else start
+        while frame in present:
+            frame += 1
+        return frame - (self.first() if start is None else start)
+
+    def file_names(self, count=None, start=None):
+        # 'count' consecutive frames from 'start' (default: all of them from
+        # the first one); raises IOError naming every missing frame, before
+        # anything gets decoded.
+        if start is None:
+            start = self.first()
+        if count is None:
+            count = self.last() + 1 - start
+        present = set(self.frames)
+        missing = [frame for frame in xrange(start, start + count) if frame not in present]
+        if missing:
+            raise IOError("{}: {} of frames {}-{} missing ({}{})".format(
+                self.fileMask, len(missing), start, start + count - 1,
+                ", ".join(str(frame) for frame in missing[0:8]), ", ..." if len(missing) > 8 else ""))
+        return [self.file_name(frame) for frame in xrange(start, start + count)]
+
+
+def frame_pattern(prefix, suffix):
+    # Names of frames between 'prefix' and 'suffix', the number as group 1.
+    return re.compile(re.escape(prefix) + r"(\d+)" + re.escape(suffix) + "$")
+
+
+def list_directory(directory, pattern):
+    # File names in 'directory' matching 'pattern'. Names are filtered before
+    # anything is stat'ed; scandir skips the stat on Windows altogether.
+    if scandir is None:
+        return [name for name in os.listdir(directory)
+                if pattern.match(name) and os.path.isfile(os.path.join(directory, name))]
+    return [entry.name for entry in scandir(directory) if pattern.match(entry.name) and entry.is_file()]
+
+
+def group_frames(directory, prefix, suffix, fileNames):
+    # Names matching frame_pattern(prefix, suffix) -> FrameSequence per
+    # padding. A number without leading zeros joins the widest padding it
+    # fits, so 0998, 0999, 1000 stay one sequence and unpadded 1..12 are one
+    # with padding 1.
+    pattern = frame_pattern(prefix, suffix)
+    digitsList = [pattern.match(fileName).group(1) for fileName in fileNames]
+    paddings = sorted(set(len(digits) for digits in digitsList if digits[0] == '0' and len(digits) > 1))
+    frames = collections.defaultdict(list)
+    for digits in digitsList:
+        padding = max([p for p in paddings if p <= len(digits)] or [1])
+        frames[padding].append(int(digits))
+    return [FrameSequence(directory, prefix, padding, suffix, frames[padding]) for padding in sorted(frames.keys())]
+
+
+def scan_directory(directory, prefix, suffix):
+    # Frame sequences named prefix + number + suffix in 'directory', listed
+    # once per directory mtime.
+    directory = os.path.abspath(directory)
+    mtime = os.stat(directory).st_mtime
+    key = (directory, prefix, suffix)
+    with g_scanCacheLock:
+        cached = g_scanCache.get(key)
+    if cached is not None and cached[0] == mtime:
+        return cached[1]
+
+    sequences = group_frames(directory, prefix, suffix, list_directory(directory, frame_pattern(prefix, suffix)))
+    with g_scanCacheLock:
+        g_scanCache[key] = (mtime, sequences)
+    return sequences
+
+
+def is_sequence(source):
+    # A FrameSequence or a '{}' frame mask, as opposed to a finished sheet.
+    return isinstance(source, FrameSequence) or "{}" in source
+
+
+def find_sequence(source):
+    # FrameSequence for a '{}' frame mask ('C:/ffx/smoke.{}.tga',
+    # 'render_{}.beauty.tga'), or the handle itself. With several paddings
+    # the longest sequence wins.
+    if isinstance(source, FrameSequence):
+        return source
+    directory, baseName = os.path.split(source)
+    prefix, _, suffix = baseName.partition("{}")
+    matches = scan_directory(directory or os.curdir, prefix, suffix)
+    if not matches:
+        raise IOError("No frames match {}".format(source))
+    return max(matches, key=len)
+
+
+def output_name(source, tag):
+    # fileMask.format(tag) for a frame mask or a handle, without scanning.
+    if isinstance(source, FrameSequence):
+        return source.output_name(tag)
+    return source.format(tag)
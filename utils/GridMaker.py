@@ -1,293 +1,1517 @@
+import os
 import sys
+import json
+import time
 import math
-from PIL import Image, ImageOps, ImageChops
-
-def process_ffx(fileMask, gridSize=(8, 8), smoothBorders=False):
-
-    frameSize = Image.open(fileMask.format(str(0).zfill(4))).size
-    outImgSize = (gridSize[0] * frameSize[0], gridSize[1] * frameSize[1])
-
-    outImg = Image.new('RGBA', outImgSize)
-    alphaMultImg = Image.new('L', outImgSize)
-
-    x = 0
-    y = 0
-    for frameIdx in xrange(0, gridSize[0] * gridSize[1]):
-
-        frame = Image.open(fileMask.format(str(frameIdx).zfill(4)))
-        frame.thumbnail(frameSize)
-
-        alphaMultFrame = Image.open("C:/Projects/vfxutils/textures/alpha_mask.tga")
-        alphaMultFrame.thumbnail(frameSize)
-
-        location = (x * frameSize[0], y * frameSize[1])
-
-        outImg.paste(frame, location)
-        alphaMultImg.paste(alphaMultFrame, location)
-
-        x += 1
-        if x >= gridSize[0]:
-            x = 0
-            y += 1
-
+import struct
+import hashlib
+import threading
+import collections
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+import numpy as np
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+from PIL import Image
+
+from AtlasWriter import AtlasWriter, frame_pixels, open_canvas, open_image_writer, open_png_stream
+from TgaFile import open_tga, TgaImage
+from RectPacker import trim_box, pack_rects
+from OpticalFlow import match_image, estimate_flow
+from MipChain import push_pull_fill, mip_chain
+from BlockCompress import SOURCE_MODES, encode_blocks
+from DdsFile import DdsStreamWriter
+from DistanceField import signed_distance
+from FrameSequence import find_sequence, is_sequence, output_name
+import Profiler
+from Profiler import Stage
+
+# Pixels per chunk for whole-array normal map math (bounds float32 temporaries).
+NM_BLEND_CHUNK = 1 << 20
+
+ALPHA_MASK_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "textures", "alpha_mask.tga")
+
+# Bump when the manifest layout or the cell pipeline changes.
+SHEET_MANIFEST_VERSION = 1
+
+# Atlas rows per band for whole-sheet kernels (bounds memory on 8k atlases).
+TILE_ROWS = 256
+
+UV_TABLE_MAGIC = b"FBUV"
+UV_TABLE_VERSION = 1
+
+# Sheet rows per block compression job (a multiple of 4).
+BC_BAND_ROWS = 64
+
+# Results (decoded frames) run_ordered() keeps ready ahead of the consumer.
+PREFETCH_DEPTH = 4
+
+# (frameSize, falloff) -> read-only uint8 mask, shared by every call in the process
+g_alphaMaskCache = {}
+
+# (path, frameSize, mtime, file size) -> read-only decoded frame, least recently
+# used first. Off unless set_frame_cache_limit() gives it a budget (GridWorker).
+g_frameCache = collections.OrderedDict()
+g_frameCacheBytes = 0
+g_frameCacheLimit = 0
+g_frameCacheLock = threading.Lock()
+
+def get_alpha_mask(frameSize, falloff=None):
+    # falloff=None resamples textures/alpha_mask.tga, otherwise a procedural
+    # smoothstep ramp is built whose width is 'falloff' of the frame size.
+    frameSize = tuple(frameSize)
+    key = (frameSize, falloff)
+    mask = g_alphaMaskCache.get(key)
+    if mask is not None:
+        return mask
+
+    if falloff is None:
+        srcImg = Image.open(ALPHA_MASK_PATH)
+        maskImg = srcImg.copy()
+        maskImg.thumbnail(frameSize)
+        if maskImg.size != frameSize:
+            maskImg = srcImg.resize(frameSize, Image.BICUBIC)
+        mask = np.array(maskImg.convert('L'))
+    else:
+        def ramp(length):
+            edge = np.minimum(np.arange(length), np.arange(length)[::-1]) + 0.5
+            t = np.clip(edge / max(falloff * length, 1.0), 0.0, 1.0)
+            return t * t * (3.0 - 2.0 * t)
+        mask = np.outer(ramp(frameSize[1]), ramp(frameSize[0]))
+        mask = np.round(mask * 255.0).astype(np.uint8)
+
+    mask.flags.writeable = False
+    g_alphaMaskCache[key] = mask
+    return mask
+
+def apply_alpha_mask(pixels, mask):
+    # In-place alpha *= mask / 255 (truncating, as ImageChops.multiply) over
+    # an (H, W, 4) region made of whole cells, without tiling the mask.
+    cellH, cellW = mask.shape
+    cells = pixels.reshape(pixels.shape[0] // cellH, cellH, pixels.shape[1] // cellW, cellW, 4)
+    alpha = cells[..., 3]
+    alpha[...] = alpha * mask[None, :, None, :].astype(np.uint16) // 255
+    return pixels
+
+def set_frame_cache_limit(maxBytes):
+    global g_frameCacheLimit
+    with g_frameCacheLock:
+        g_frameCacheLimit = maxBytes
+        trim_frame_cache()
+
+def trim_frame_cache():
+    # caller holds g_frameCacheLock
+    global g_frameCacheBytes
+    while g_frameCache and g_frameCacheBytes > g_frameCacheLimit:
+        key, frame = g_frameCache.popitem(last=False)
+        g_frameCacheBytes -= frame.nbytes
+
+def load_frame(fileName, frameSize=None):
+    # Frame pixels as a uint8 array (2D gray, RGB or RGBA) that fits in
+    # frameSize. With a frame cache budget, repeated loads of an unchanged
+    # file return the same read-only array.
+    global g_frameCacheBytes
+    if g_frameCacheLimit <= 0:
+        return decode_frame_file(fileName, frameSize)
+
+    stat = os.stat(fileName)
+    key = (os.path.abspath(fileName), None if frameSize is None else tuple(frameSize), stat.st_mtime, stat.st_size)
+    with g_frameCacheLock:
+        frame = g_frameCache.pop(key, None)
+        if frame is not None:
+            g_frameCache[key] = frame
+            return frame
+
+    frame = decode_frame_file(fileName, frameSize)
+    frame.flags.writeable = False
+    with g_frameCacheLock:
+        if key not in g_frameCache:
+            g_frameCache[key] = frame
+            g_frameCacheBytes += frame.nbytes
+            trim_frame_cache()
+    return frame
+
+def decode_frame_file(fileName, frameSize=None):
+    # Uncompressed TGAs are read straight from a memory mapping, anything
+    # else (or anything that needs shrinking) goes through PIL.
+    with Stage("decode", readFile=fileName):
+        tga = open_tga(fileName)
+        if tga is not None:
+            with tga:
+                if frameSize is None or (tga.size[0] <= frameSize[0] and tga.size[1] <= frameSize[1]):
+                    return tga.read()
+
+        frame = Image.open(fileName)
+        if frameSize is not None:
+            frame.draft(None, frameSize)
+        frame.load()
+
+    if frameSize is not None:
+        with Stage("thumbnail"):
+            frame.thumbnail(frameSize)
+    if frame.mode not in ('L', 'RGB', 'RGBA'):
+        frame = frame.convert('RGBA')
+    return np.asarray(frame)
+
+class LoadedImage(object):
+    # TgaImage-like read(box) over a PIL-decoded image, for files that
+    # can't be memory-mapped.
+
+    def __init__(self, fileName):
+        with Stage("decode", readFile=fileName):
+            img = Image.open(fileName)
+            if img.mode not in ('L', 'RGB', 'RGBA'):
+                img = img.convert('RGBA')
+            self.size = img.size
+            self.mode = img.mode
+            self.pixels = np.asarray(img)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        self.close()
+
+    def read(self, box=None):
+        if box is None:
+            return self.pixels
+        left, top, right, bottom = box
+        return self.pixels[top:bottom, left:right]
+
+    def close(self):
+        self.pixels = None
+
+def open_image(fileName, sequential=False):
+    # TgaImage or LoadedImage with read(box); 'sequential' callers that read
+    # top to bottom get PNGs decoded band by band instead of all at once.
+    tga = open_tga(fileName)
+    if tga is not None:
+        return tga
+    if sequential and os.path.splitext(fileName)[1].lower() == '.png':
+        png = open_png_stream(fileName)
+        if png is not None:
+            return png
+    return LoadedImage(fileName)
+
+def decode_frame(job):
+    frameIdx, fileName, frameSize = job
+    return frameIdx, load_frame(fileName, frameSize)
+
+def decode_frames(jobs, workers=1, poolType='thread', depth=PREFETCH_DEPTH):
+    # Yields (frameIdx, pixels) in job order, decoded in the background at
+    # most 'depth' frames (plus one per worker) ahead of the consumer.
+    # workers=None uses all cores.
+    return run_ordered(decode_frame, jobs, workers, poolType, depth)
+
+def frame_source(fileNames, frameSize=None, workers=1, poolType='thread', depth=PREFETCH_DEPTH):
+    # decode_frames() over a list of files: (index in fileNames, pixels).
+    jobs = [(frameIdx, fileName, frameSize) for frameIdx, fileName in enumerate(fileNames)]
+    return decode_frames(jobs, workers, poolType, depth)
+
+def prefetch(items, depth=PREFETCH_DEPTH):
+    # Yields 'items' in order while a background thread runs the iterator up
+    # to 'depth' items ahead, so producing item N + 1 overlaps consuming item
+    # N. An exception in the iterator is raised at the same position here.
+    if depth <= 0:
+        for item in items:
+            yield item
+        return
+
+    ready = queue.Queue(depth)
+    stop = threading.Event()
+    done = object()
+    stages = Profiler.open_stages()
+
+    def put(entry):
+        while not stop.is_set():
+            try:
+                ready.put(entry, True, 0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        Profiler.adopt_stages(stages)
+        try:
+            for item in items:
+                if not put((item, None)):
+                    return
+            put((done, None))
+        except Exception as e:
+            put((done, e))
+        finally:
+            if hasattr(items, 'close'):
+                items.close()
+
+    thread = threading.Thread(target=produce)
+    thread.daemon = True
+    thread.start()
+    try:
+        while True:
+            item, error = ready.get()
+            if item is done:
+                if error is not None:
+                    raise error
+                return
+            yield item
+    finally:
+        # the consumer stopped early or finished: release the producer
+        stop.set()
+        thread.join()
+
+def run_ordered(func, jobs, workers=1, poolType='thread', depth=PREFETCH_DEPTH):
+    # Yields func(job) in job order with at most workers + depth jobs in
+    # flight or waiting. A single worker runs on a prefetch() thread.
+    # 'process' pools need a module level func.
+    if workers is not None and workers <= 1:
+        for result in prefetch((func(job) for job in jobs), depth):
+            yield result
+        return
+
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+
+    if poolType == 'process':
+        pool = multiprocessing.Pool(workers)
+    elif poolType == 'thread':
+        pool = ThreadPool(workers)
+    else:
+        raise ValueError("Unknown pool type '{}'".format(poolType))
+
+    # pool processes record their own stages and send them back
+    profile = Profiler.active_profile() if poolType == 'process' else None
+
+    def submit(job):
+        if profile is None:
+            return pool.apply_async(func, (job,))
+        return pool.apply_async(Profiler.profiled_call, ((func, job),))
+
+    def collect(pending):
+        if profile is None:
+            return pending.get()
+        result, events, threadNames = pending.get()
+        profile.extend(events, threadNames)
+        return result
+
+    try:
+        pending = collections.deque()
+        for job in jobs:
+            pending.append(submit(job))
+            if len(pending) >= workers + depth:
+                yield collect(pending.popleft())
+        while pending:
+            yield collect(pending.popleft())
+    finally:
+        pool.terminate()
+        pool.join()
+
+def file_hash(fileName):
+    md5 = hashlib.md5()
+    with open(fileName, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+def frame_record(fileName, prevRecord=None):
+    # Unchanged size and mtime reuse the previous hash instead of rereading the file.
+    stat = os.stat(fileName)
+    record = {'file': os.path.basename(fileName), 'size': stat.st_size, 'mtime': stat.st_mtime}
+    if prevRecord and prevRecord.get('size') == stat.st_size and prevRecord.get('mtime') == stat.st_mtime:
+        record['hash'] = prevRecord['hash']
+    else:
+        record['hash'] = file_hash(fileName)
+    return record
+
+def sheet_manifest_path(atlasFile):
+    return os.path.splitext(atlasFile)[0] + ".json"
+
+def load_sheet_manifest(atlasFile, params):
+    # Previous frame records, or None if the atlas can't be reused as-is.
+    try:
+        with open(sheet_manifest_path(atlasFile)) as f:
+            manifest = json.load(f)
+        stat = os.stat(atlasFile)
+    except (IOError, OSError, ValueError):
+        return None
+
+    if manifest.get('version') != SHEET_MANIFEST_VERSION or manifest.get('params') != params:
+        return None
+    atlas = manifest.get('atlas', {})
+    if atlas.get('size') != stat.st_size or atlas.get('mtime') != stat.st_mtime:
+        return None
+    return manifest.get('frames')
+
+def save_sheet_manifest(atlasFile, params, frames):
+    stat = os.stat(atlasFile)
+    manifest = {
+        'version': SHEET_MANIFEST_VERSION,
+        'params': params,
+        'atlas': {'size': stat.st_size, 'mtime': stat.st_mtime},
+        'frames': frames,
+    }
+    with open(sheet_manifest_path(atlasFile), 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+
+def replace_file(srcFile, dstFile):
+    # os.rename() won't overwrite on Windows
+    if os.path.exists(dstFile):
+        os.remove(dstFile)
+    os.rename(srcFile, dstFile)
+
+def same_file(fileA, fileB):
+    # os.path.samefile() is missing on Windows under Python 2
+    return os.path.normcase(os.path.realpath(fileA)) == os.path.normcase(os.path.realpath(fileB))
+
+def staging_file(dstFile, srcFiles):
+    # Where to write dstFile: a temp file next to it when it is one of the
+    # sources, which may be memory-mapped and must not be truncated while
+    # they are read. Swap it in with finish_staging() once they are closed.
+    if any(same_file(dstFile, srcFile) for srcFile in srcFiles):
+        return "{}.tmp{}".format(*os.path.splitext(dstFile))
+    return dstFile
+
+def finish_staging(tmpFile, dstFile):
+    if tmpFile != dstFile:
+        replace_file(tmpFile, dstFile)
+
+def cell_box(frameIdx, gridSize, frameSize):
+    left = (frameIdx % gridSize[0]) * frameSize[0]
+    top = (frameIdx // gridSize[0]) * frameSize[1]
+    return (left, top, left + frameSize[0], top + frameSize[1])
+
+def frame_cell(frame, frameSize, alphaMask=None):
+    # Frame -> full (h, w, 4) cell, frame at the top-left like Image.paste().
+    pixels = frame_pixels(frame, 'RGBA')
+    cell = np.zeros((frameSize[1], frameSize[0], 4), np.uint8)
+    cell[0:pixels.shape[0], 0:pixels.shape[1]] = pixels
+    if alphaMask is not None:
+        with Stage("alpha mask"):
+            apply_alpha_mask(cell, alphaMask)
+    return cell
+
+def cell_signature(cell, blocks=8):
+    # Per-channel means over a blocks x blocks grid. Their mean absolute
+    # difference never exceeds the full-resolution one, so it safely prunes.
+    h = cell.shape[0] - cell.shape[0] % blocks
+    w = cell.shape[1] - cell.shape[1] % blocks
+    grid = cell[0:h, 0:w].reshape(blocks, h // blocks, blocks, w // blocks, -1)
+    return grid.mean(axis=(1, 3), dtype=np.float32).ravel() / 255.0
+
+def fold_frames(cells, threshold=0.0):
+    # Maps every cell to the first identical one (by content hash) or, with
+    # threshold > 0, to the first whose mean absolute error / 255 is within
+    # it. Returns (indices of the kept cells, per-cell index into them).
+    unique = []
+    remap = []
+    hashes = {}
+    signatures = []
+
+    for i, cell in enumerate(cells):
+        key = hashlib.md5(np.ascontiguousarray(cell).tobytes()).hexdigest()
+        match = hashes.get(key)
+
+        if match is None and threshold > 0.0:
+            signature = cell_signature(cell)
+            if signatures:
+                errors = np.abs(np.array(signatures) - signature).mean(axis=1)
+                for j in np.argsort(errors):
+                    if errors[j] > threshold:
+                        break
+                    error = np.abs(cells[unique[j]].astype(np.int16) - cell).mean() / 255.0
+                    if error <= threshold:
+                        match = int(j)
+                        break
+
+        if match is None:
+            match = len(unique)
+            unique.append(i)
+            hashes[key] = match
+            if threshold > 0.0:
+                signatures.append(signature)
+        remap.append(match)
+
+    return unique, remap
+
+def shrink_grid(gridSize, cellCount):
+    # Halves the longer grid side (rows on a tie) while the cells still fit,
+    # so power-of-two sheets stay power-of-two.
+    cols, rows = gridSize
+    while True:
+        halveCols = (cols // 2) * rows >= cellCount and cols > 1
+        halveRows = cols * (rows // 2) >= cellCount and rows > 1
+        if halveCols and (cols > rows or not halveRows):
+            cols //= 2
+        elif halveRows:
+            rows //= 2
+        else:
+            return (cols, rows)
+
+def grow_grid(gridSize, cellCount):
+    # Doubles the shorter grid side (columns on a tie) until the cells fit.
+    cols, rows = gridSize
+    while cols * rows < cellCount:
+        if cols <= rows:
+            cols *= 2
+        else:
+            rows *= 2
+    return (cols, rows)
+
+def write_folded_sheet(outFile, cells, frameSize, gridSize, threshold=0.0, mode='RGBA'):
+    # Writes only the distinct cells on the smallest grid that holds them and
+    # a <sheet>.remap.json table from source frame to atlas cell.
+    with Stage("fold"):
+        unique, remap = fold_frames(cells, threshold)
+    foldedGrid = shrink_grid(gridSize, len(unique))
+
+    with AtlasWriter(outFile, frameSize, foldedGrid, mode) as atlas:
+        for i in unique:
+            atlas.paste(cells[i])
+
+    with open(os.path.splitext(outFile)[0] + ".remap.json", 'w') as f:
+        json.dump({'gridSize': list(foldedGrid), 'sourceGridSize': list(gridSize), 'frames': remap}, f, indent=1)
+
+    print("{}: {} frames folded into {} cells, grid {}x{}".format(
+        os.path.basename(outFile), len(cells), len(unique), foldedGrid[0], foldedGrid[1]))
+    return foldedGrid, remap
+
+def process_ffx(fileMask, gridSize=(8, 8), smoothBorders=False, borderFalloff=None, workers=1, poolType='thread', incremental=True,
+                foldDuplicates=False, foldThreshold=0.0):
+
+    sequence = find_sequence(fileMask)
+    frameCount = gridSize[0] * gridSize[1]
+    fileNames = sequence.file_names(frameCount)
+    frameSize = Image.open(fileNames[0]).size
+    outFile = sequence.output_name("combined")
+
+    alphaMask = None
     if smoothBorders:
-        r, g, b, a = outImg.split()
-        a = ImageChops.multiply(a, alphaMultImg)
-        outImg = Image.merge("RGBA", (r, g, b, a))
-
-    outImg.save(fileMask.format("combined"))
-
-def process_ffx_loop():
-    frameSize = (256, 256)
-    gridSize = (8, 4)
-
-    totalFrames = gridSize[0] * gridSize[1]
-    offset = 4
-
-    outImageSize = (gridSize[0] * frameSize[0], gridSize[1] * frameSize[1])
-    outImage = Image.new('RGBA', outImageSize)
-    #alphaMultImage = Image.new('L', outImageSize)
-
-    x = 0
-    y = 0
-    for i in xrange(1, totalFrames + 1):
-
-        frameIdx = i + offset
-
-        frame = Image.open("C:/Projects/ffx/images/test2.{}.tga".format(str(frameIdx).zfill(4)))
-        frame.thumbnail(frameSize)
-
-        if i <= offset and False:
-            frameIdx2 = totalFrames + i
-            frame2 = Image.open("C:/Projects/ffx/images/test2.{}.tga".format(str(frameIdx2).zfill(4)))
-            frame2.thumbnail(frameSize)
-
-            _x = i
-            opacity = 0.5 + 0.5 * _x / float(offset + 0.5)
-
-            frame = Image.blend(frame2, frame, opacity)
-
-        elif i >= totalFrames - offset and False:
-            frameIdx2 = offset + 1 - (totalFrames - i)
-            frame2 = Image.open("C:/Projects/ffx/images/test2.{}.tga".format(str(frameIdx2).zfill(4)))
-            frame2.thumbnail(frameSize)
-
-            _x = totalFrames - i
-            opacity = 0.5 * (offset + 0.5 - _x) / float(offset + 0.5)
-
-            frame = Image.blend(frame, frame2, opacity)
-
-        #alphaMult = Image.open("C:/Projects/vfxutils/textures/alpha_mask.tga")
-        #alphaMult.thumbnail(frameSize)
-
-        location = (x * frameSize[0], y * frameSize[1])
-
-        outImage.paste(frame, location)
-        #alphaMultImage.paste(alphaMult, location)
-
-        x += 1
-        if x >= gridSize[0]:
-            x = 0
-            y += 1
-
-    # Make smooth borders
-    #r, g, b, a = outImage.split()
-    #a = ImageChops.multiply(a, alphaMultImage)
-    #outImage = Image.merge("RGBA", (r, g, b, a))
-
-    outImage.save("y:/art/source/particles/textures/special/ffx_loop_test.tga")
-
-def rearrange_frames():
-    srcImg = Image.open("y:/art/source/particles/textures/fire_AAA_5.png")
-    frameSize = (512, 512)
-    gridSize = (8, 8)
+        alphaMask = get_alpha_mask(frameSize, borderFalloff)
+
+    if foldDuplicates:
+        # the cell layout depends on every frame, so folded sheets are always rebuilt
+        jobs = [(frameIdx, fileNames[frameIdx], frameSize) for frameIdx in xrange(0, frameCount)]
+        cells = [frame_cell(frame, frameSize, alphaMask) for frameIdx, frame in decode_frames(jobs, workers, poolType)]
+        write_folded_sheet(outFile, cells, frameSize, gridSize, foldThreshold)
+        return 0
+
+    params = {
+        'fileMask': sequence.fileMask,
+        'firstFrame': sequence.first(),
+        'gridSize': list(gridSize),
+        'frameSize': list(frameSize),
+        'smoothBorders': smoothBorders,
+        'borderFalloff': borderFalloff,
+    }
+    prevRecords = load_sheet_manifest(outFile, params) if incremental else None
+
+    records = [frame_record(fileNames[i], prevRecords[i] if prevRecords else None) for i in xrange(0, frameCount)]
+    reused = [prevRecords is not None and records[i]['hash'] == prevRecords[i]['hash'] for i in xrange(0, frameCount)]
+
+    if all(reused):
+        save_sheet_manifest(outFile, params, records)
+        print("{}: up to date, {} of {} cells reused".format(os.path.basename(outFile), frameCount, frameCount))
+        return frameCount
+
+    jobs = [(frameIdx, fileNames[frameIdx], frameSize) for frameIdx in xrange(0, frameCount) if not reused[frameIdx]]
+    frames = decode_frames(jobs, workers, poolType)
+
+    atlasTga = open_tga(outFile, writable=True) if any(reused) else None
+    if atlasTga is not None and atlasTga.size != (gridSize[0] * frameSize[0], gridSize[1] * frameSize[1]):
+        atlasTga.close()
+        atlasTga = None
+
+    if atlasTga is not None:
+        # uncompressed TGA atlas: only changed cells are written, in place
+        with atlasTga:
+            for frameIdx, frame in frames:
+                atlasTga.write(frame_cell(frame, frameSize, alphaMask), cell_box(frameIdx, gridSize, frameSize)[0:2])
+        os.utime(outFile, None)
+    else:
+        # frames arrive in order, so each grid row is encoded as soon as it is full
+        # and the previous atlas is read one grid row at a time alongside; it is
+        # only replaced once the new one is complete
+        prevSheet = open_image(outFile, sequential=True) if any(reused) else None
+        tmpFile = "{}.tmp{}".format(*os.path.splitext(outFile))
+        try:
+            with AtlasWriter(tmpFile, frameSize, gridSize, 'RGBA') as atlas:
+                for frameIdx in xrange(0, frameCount):
+                    left, top, right, bottom = cell_box(frameIdx, gridSize, frameSize)
+                    if frameIdx % gridSize[0] == 0 and prevSheet is not None:
+                        prevRow = frame_pixels(prevSheet.read((0, top, prevSheet.size[0], bottom)), 'RGBA')
+                    if reused[frameIdx]:
+                        atlas.paste(prevRow[:, left:right])
+                    else:
+                        frame = next(frames)[1]
+                        atlas.paste(frame_cell(frame, frameSize, alphaMask))
+        finally:
+            if prevSheet is not None:
+                prevSheet.close()
+
+        replace_file(tmpFile, outFile)
+
+    save_sheet_manifest(outFile, params, records)
+
+    reusedCount = sum(reused)
+    print("{}: {} of {} cells reused".format(os.path.basename(outFile), reusedCount, frameCount))
+    return reusedCount
+
+def save_uv_table(baseName, atlasSize, frameSize, rects):
+    # rects: per frame (x, y, w, h) in the atlas and (left, top) of the trimmed
+    # area inside the source frame. Writes <baseName>.json for tools and
+    # <baseName>.bin for the game: header, then per frame u0 v0 u1 v1 and the
+    # trimmed area as x y w h in frame units, all little-endian float32.
+    frames = []
+    binary = [struct.pack('<4sIIHHHH', UV_TABLE_MAGIC, UV_TABLE_VERSION, len(rects),
+                          atlasSize[0], atlasSize[1], frameSize[0], frameSize[1])]
+
+    for (x, y, w, h), (left, top) in rects:
+        uv = [float(x) / atlasSize[0], float(y) / atlasSize[1],
+              float(x + w) / atlasSize[0], float(y + h) / atlasSize[1]]
+        trim = [float(left) / frameSize[0], float(top) / frameSize[1],
+                float(w) / frameSize[0], float(h) / frameSize[1]]
+        # source frame center, relative to the trimmed rect
+        pivot = [(frameSize[0] * 0.5 - left) / w if w else 0.5,
+                 (frameSize[1] * 0.5 - top) / h if h else 0.5]
+        frames.append({'rect': [x, y, w, h], 'offset': [left, top], 'uv': uv, 'pivot': pivot})
+        binary.append(struct.pack('<8f', *(uv + trim)))
+
+    with open(baseName + ".json", 'w') as f:
+        json.dump({'atlasSize': list(atlasSize), 'frameSize': list(frameSize), 'uvOrigin': 'top-left', 'frames': frames}, f, indent=1)
+    with open(baseName + ".bin", 'wb') as f:
+        f.write(b"".join(binary))
+
+def process_ffx_packed(fileMask, frameCount=None, padding=1, alphaThreshold=0, maxSize=8192, workers=1, poolType='thread'):
+    # Trims every frame to its alpha bounding box and packs the rects into the
+    # smallest power-of-two atlas, with a UV table next to it. frameCount=None
+    # takes every frame up to the first gap.
+    sequence = find_sequence(fileMask)
+    if frameCount is None:
+        frameCount = sequence.run_length()
+    fileNames = sequence.file_names(frameCount)
+    frameSize = Image.open(fileNames[0]).size
+    jobs = [(frameIdx, fileNames[frameIdx], frameSize) for frameIdx in xrange(0, frameCount)]
+
+    crops = []
+    offsets = []
+    for frameIdx, frame in decode_frames(jobs, workers, poolType):
+        pixels = frame_pixels(frame, 'RGBA')
+        box = trim_box(pixels, alphaThreshold)
+        if box is None:
+            crops.append(pixels[0:0, 0:0])
+            offsets.append((0, 0))
+        else:
+            crops.append(pixels[box[1]:box[3], box[0]:box[2]])
+            offsets.append(box[0:2])
+
+    sizes = [(crop.shape[1], crop.shape[0]) for crop in crops]
+    atlasSize, positions = pack_rects(sizes, padding, maxSize)
+
+    outFile = sequence.output_name("packed")
+    with open_canvas(outFile, atlasSize, 'RGBA') as atlas:
+        for crop, position in zip(crops, positions):
+            if crop.size:
+                atlas.write(crop, position)
+
+    rects = [((x, y, w, h), offset) for (x, y), (w, h), offset in zip(positions, sizes, offsets)]
+    save_uv_table(os.path.splitext(outFile)[0], atlasSize, frameSize, rects)
+
+    print("{}: {} frames packed into {}x{}".format(os.path.basename(outFile), frameCount, atlasSize[0], atlasSize[1]))
+    return atlasSize
+
+def motion_frame(job):
+    frameIdx, fileName, nextFileName, frameSize = job
+    if nextFileName is None:
+        return frameIdx, np.zeros((frameSize[1], frameSize[0], 2), np.float32)
+    src = match_image(load_frame(fileName, frameSize))
+    dst = match_image(load_frame(nextFileName, frameSize))
+    with Stage("optical flow"):
+        return frameIdx, estimate_flow(src, dst)
+
+def encode_motion(flow, frameSize, scale, invertY=False):
+    # Pixel flow -> RG8 cell: motion in frame UVs / scale, 128 is still.
+    uv = flow / np.float32((frameSize[0] * scale, frameSize[1] * scale))
+    if invertY:
+        uv[:, :, 1] = -uv[:, :, 1]
+    cell = np.zeros(flow.shape[0:2] + (3,), np.uint8)
+    cell[:, :, 0:2] = np.clip(np.round(uv * 127.5 + 127.5), 0.0, 255.0)
+    return cell
+
+def process_ffx_motion(fileMask, gridSize=(8, 8), loop=False, scale=None, invertY=False, workers=None, poolType='process'):
+    # Companion motion vector sheet for process_ffx output, same frames and
+    # layout: each cell holds the flow that carries frame i onto frame i + 1
+    # (the last frame wraps to the first with 'loop', otherwise it is still).
+    # R/G store +x/+y (image down, or up with invertY) in frame UVs divided by
+    # 'scale'; scale=None fits the largest motion and the scale used goes to
+    # <sheet>.json for the shader.
+    sequence = find_sequence(fileMask)
+    frameCount = gridSize[0] * gridSize[1]
+    fileNames = sequence.file_names(frameCount)
+    frameSize = Image.open(fileNames[0]).size
+    outFile = sequence.output_name("motion")
+
+    nextFileNames = fileNames[1:] + [fileNames[0] if loop else None]
+    jobs = [(frameIdx, fileNames[frameIdx], nextFileNames[frameIdx], frameSize) for frameIdx in xrange(0, frameCount)]
+    flows = run_ordered(motion_frame, jobs, workers, poolType)
+
+    if scale is None:
+        # the scale depends on every frame; flows are kept at half precision
+        flows = [(frameIdx, flow.astype(np.float16)) for frameIdx, flow in flows]
+        maxMotion = max(max(np.abs(flow[:, :, 0]).max() / frameSize[0], np.abs(flow[:, :, 1]).max() / frameSize[1])
+                        for frameIdx, flow in flows)
+        scale = max(float(maxMotion), 1.0 / 255.0)
+
+    with AtlasWriter(outFile, frameSize, gridSize, 'RGB') as atlas:
+        for frameIdx, flow in flows:
+            atlas.paste(encode_motion(flow.astype(np.float32), frameSize, scale, invertY))
+
+    with open(os.path.splitext(outFile)[0] + ".json", 'w') as f:
+        json.dump({'gridSize': list(gridSize), 'frameSize': list(frameSize), 'scale': scale,
+                   'loop': loop, 'invertY': invertY}, f, indent=1)
+
+    print("{}: {} motion frames, scale {:.4f}".format(os.path.basename(outFile), frameCount, scale))
+    return scale
+
+def sdf_frame(job):
+    # Full resolution frame -> (h, w, 4) cell: RGB dilated and box filtered,
+    # alpha the signed distance to the alphaRef silhouette in cell texels,
+    # 128 on the edge and 0/255 at 'spread' texels out/in.
+    frameIdx, fileName, cellSize, alphaRef, spread = job
+    pixels = frame_pixels(load_frame(fileName), 'RGBA')
+    with Stage("dilate"):
+        pixels = push_pull_fill(pixels[None])[0]
+    with Stage("distance field"):
+        distance = signed_distance(pixels[:, :, 3] > alphaRef) * np.float32(float(cellSize[0]) / pixels.shape[1])
+
+    cell = np.empty((cellSize[1], cellSize[0], 4), np.uint8)
+    cell[:, :, 0:3] = np.asarray(Image.fromarray(np.ascontiguousarray(pixels[:, :, 0:3])).resize(cellSize, Image.BOX))
+    distance = np.asarray(Image.fromarray(distance, 'F').resize(cellSize, Image.BOX))
+    cell[:, :, 3] = np.clip(np.round(127.5 - distance * (127.5 / spread)), 0.0, 255.0)
+    return frameIdx, cell
+
+def process_ffx_sdf(fileMask, gridSize=(8, 8), downscale=4, spread=4.0, alphaRef=128, workers=None, poolType='process'):
+    # process_ffx layout with the alpha replaced by a signed distance field:
+    # the exact distance transform runs on the full resolution frames, the
+    # cells are 'downscale' times smaller. Frames go through a process pool.
+    sequence = find_sequence(fileMask)
+    frameCount = gridSize[0] * gridSize[1]
+    fileNames = sequence.file_names(frameCount)
+    frameSize = Image.open(fileNames[0]).size
+    cellSize = (max(1, frameSize[0] // downscale), max(1, frameSize[1] // downscale))
+    outFile = sequence.output_name("sdf")
+
+    jobs = [(frameIdx, fileNames[frameIdx], cellSize, alphaRef, spread) for frameIdx in xrange(0, frameCount)]
+    with AtlasWriter(outFile, cellSize, gridSize, 'RGBA') as atlas:
+        for frameIdx, cell in run_ordered(sdf_frame, jobs, workers, poolType):
+            atlas.paste(cell)
+
+    print("{}: {} frames, {}x{} cells".format(os.path.basename(outFile), frameCount, cellSize[0], cellSize[1]))
+
+# Channel names a pack_channels() spec can route; 'L' is PIL's luminance.
+PACK_CHANNELS = {'R': 0, 'G': 1, 'B': 2, 'A': 3, 'L': None}
+PACK_MODES = {1: 'L', 3: 'RGB', 4: 'RGBA'}
+
+def parse_pack_channel(spec, sources):
+    # 'name.C' -> (name, 'C'), a constant 0..255 -> (None, value)
+    if isinstance(spec, int):
+        return None, max(0, min(255, spec))
+    name, _, channel = spec.rpartition('.')
+    if name not in sources or channel not in PACK_CHANNELS:
+        raise ValueError("Bad channel '{}', expected 'source.R/G/B/A/L' or 0..255".format(spec))
+    return name, channel
+
+def decode_frame_set(job):
+    frameIdx, fileNames, frameSize = job
+    return frameIdx, [frame_pixels(load_frame(fileName, frameSize), 'RGBA') for fileName in fileNames]
+
+def pack_channels(outFile, sources, channels, gridSize=(8, 8), frameCount=None, workers=1, poolType='thread'):
+    # One atlas from several sources, channel by channel. 'sources' maps a
+    # name to a frame sequence (a FrameSequence or '{}' mask, as in
+    # process_ffx) or to a finished sheet on the same grid; 'channels' lists 1, 3 or 4
+    # specs for the output R[, G, B[, A]], e.g. for smoke:
+    #   pack_channels(out, {'nm': nmSheet, 'd': diffuseMask, 'e': emissiveMask},
+    #                 ('nm.R', 'nm.G', 'd.A', 'e.L'))
+    # Every source frame is decoded once, however many channels it feeds;
+    # sheets are read through their cell views.
+    routes = [parse_pack_channel(spec, sources) for spec in channels]
+    if len(routes) not in PACK_MODES:
+        raise ValueError("Expected 1, 3 or 4 channels, got {}".format(len(routes)))
+    if frameCount is None:
+        frameCount = gridSize[0] * gridSize[1]
+
+    used = sorted(set(name for name, channel in routes if name is not None))
+    sequences = [name for name in used if is_sequence(sources[name])]
+    sheets = dict((name, open_image(sources[name])) for name in used if name not in sequences)
+    tmpFile = staging_file(outFile, [sources[name] for name in sheets])
+
+    try:
+        sheetCells = dict((name, sheet_cells(sheet, gridSize)) for name, sheet in sheets.items())
+        fileNames = [find_sequence(sources[name]).file_names(frameCount) for name in sequences]
+        if sequences:
+            frameSize = Image.open(fileNames[0][0]).size
+        elif sheetCells:
+            cells = list(sheetCells.values())[0][0]
+            frameSize = (cells.shape[3], cells.shape[2])
+        else:
+            raise ValueError("No sources referenced by {}".format(channels))
+        for name, (cells, swizzle) in sheetCells.items():
+            if (cells.shape[3], cells.shape[2]) != frameSize:
+                raise ValueError("Sheet '{}' has {}x{} cells, expected {}x{}".format(
+                    name, cells.shape[3], cells.shape[2], frameSize[0], frameSize[1]))
+
+        jobs = [(frameIdx, [names[frameIdx] for names in fileNames], frameSize) for frameIdx in xrange(0, frameCount)]
+
+        with AtlasWriter(tmpFile, frameSize, gridSize, PACK_MODES[len(routes)]) as atlas:
+            for frameIdx, frames in run_ordered(decode_frame_set, jobs, workers, poolType):
+                pixels = dict(zip(sequences, frames))
+                for name, (cells, swizzle) in sheetCells.items():
+                    pixels[name] = frame_pixels(cell_pixels(cells, frameIdx, swizzle), 'RGBA')
+
+                with Stage("channel pack"):
+                    cell = np.zeros((frameSize[1], frameSize[0], len(routes)), np.uint8)
+                    for channelIdx, (name, channel) in enumerate(routes):
+                        if name is None:
+                            cell[:, :, channelIdx] = channel
+                            continue
+                        src = pixels[name]
+                        if channel == 'L':
+                            # ITU-R 601-2 in 16.16 fixed point, as PIL's convert('L')
+                            rgb = src[:, :, 0:3].astype(np.uint32)
+                            cell[0:src.shape[0], 0:src.shape[1], channelIdx] = (
+                                rgb[:, :, 0] * 19595 + rgb[:, :, 1] * 38470 + rgb[:, :, 2] * 7471) >> 16
+                        else:
+                            cell[0:src.shape[0], 0:src.shape[1], channelIdx] = src[:, :, PACK_CHANNELS[channel]]
+                atlas.paste(cell)
+    finally:
+        # views into a mapped sheet keep it mapped (and locked on Windows)
+        # past close(), so drop them before outFile may be replaced
+        sheetCells = cells = pixels = src = None
+        for sheet in sheets.values():
+            sheet.close()
+    finish_staging(tmpFile, outFile)
+
+    print("{}: {} frames packed from {}".format(os.path.basename(outFile), frameCount, ", ".join(
+        "{}:{}".format(*route) if route[0] is not None else str(route[1]) for route in routes)))
+
+def loop_features(fileNames, thumbSize=(32, 32), workers=None):
+    # (N, texels) float32 rows of alpha-premultiplied RGBA thumbnails, so
+    # colour under transparent texels doesn't count.
+    features = None
+    for i, frame in frame_source(fileNames, thumbSize, workers):
+        cell = np.zeros((thumbSize[1], thumbSize[0], 4), np.float32)
+        pixels = frame_pixels(frame, 'RGBA').astype(np.float32) / 255.0
+        cell[0:pixels.shape[0], 0:pixels.shape[1]] = pixels
+        cell[:, :, 0:3] *= cell[:, :, 3:4]
+        if features is None:
+            features = np.empty((len(fileNames), cell.size), np.float32)
+        features[i] = cell.ravel()
+    return features
+
+def frame_distance_matrix(features):
+    # RMS difference between every pair of rows: |a|^2 + |b|^2 - 2ab as one
+    # matrix product instead of N^2 image compares.
+    norms = np.einsum('ij,ij->i', features, features)
+    dist = norms[:, None] + norms[None, :] - 2.0 * np.dot(features, features.T)
+    return np.sqrt(np.maximum(dist, 0.0) / features.shape[1])
+
+def find_loop_point(dist, loopLength, maxCrossfade=8, ghostWeight=0.25):
+    # The loop plays frames [start, start + loopLength); its first 'crossfade'
+    # frames fade in from the frames that follow the loop's end, so the seam
+    # continues the rendered motion. Cost per candidate:
+    #   seam: frame distances crossed, spread over crossfade + 1 steps
+    #   ghosting: mean distance of the frame pairs mixed together
+    # Returns (start, crossfade, cost).
+    seam = np.diagonal(dist, loopLength)
+    sums = np.concatenate(([0.0], np.cumsum(seam)))
+
+    best = None
+    for crossfade in range(0, maxCrossfade + 1):
+        starts = len(seam) - crossfade
+        if starts <= 0:
+            break
+        popCost = (sums[crossfade + 1:crossfade + 1 + starts] - sums[0:starts]) / (crossfade + 1) ** 2
+        cost = popCost
+        if crossfade > 0:
+            cost = cost + ghostWeight * (sums[crossfade:crossfade + starts] - sums[0:starts]) / crossfade
+        start = int(np.argmin(cost))
+        if best is None or cost[start] < best[2]:
+            best = (start, crossfade, float(cost[start]))
+
+    if best is None:
+        raise ValueError("Sequence is too short for a {} frame loop".format(loopLength))
+    return best
+
+def process_ffx_loop(fileMask="C:/Projects/ffx/images/test2.{}.tga", gridSize=(8, 4), frameSize=(256, 256),
+                     offset=4, crossfade=0, outFile="y:/art/source/particles/textures/special/ffx_loop_test.tga",
+                     findLoop=False, firstFrame=1, frameCount=None, maxCrossfade=8, curve='linear', normalMap=False,
+                     workers=None):
+    # Loop of gridSize frames starting 'offset' frames after firstFrame
+    # (None: the sequence's first frame). With findLoop the whole rendered
+    # sequence is scanned for the offset and crossfade length with the least
+    # visible seam first.
     totalFrames = gridSize[0] * gridSize[1]
-
-    outImageSize = (gridSize[0] * frameSize[0], gridSize[1] * frameSize[1])
-    outImage = Image.new('RGBA', outImageSize)
-
-    x = 0
-    y = 0
-    for i in xrange(0, totalFrames):
-        left = x * frameSize[0]
-        top = y * frameSize[1]
-        right = (x+1) * frameSize[0]
-        bottom = (y+1) * frameSize[1]
-        frame = srcImg.crop((left, top, right, bottom)).rotate(90)
-
-        location = (x * frameSize[0], y * frameSize[1])
-
-        outImage.paste(frame, location)
-
-        x += 1
-        if x >= gridSize[0]:
-            x = 0
-            y += 1
-
-        outImage.save("y:/art/source/particles/textures/fire_AAA_5.tga")
-
-def combine_ffx_normals(fileMaskForward, fileMaskInverted):
-    nm1 = Image.open(fileMaskForward.format("combined")) # forward
-    nm2 = Image.open(fileMaskInverted.format("combined")) # inverted
-
-    r, g, b, a = nm1.split()
-    nm1 = Image.merge("RGB", (r, g, b))
-    r, g, b, a = nm2.split()
-    nm2 = Image.merge("RGB", (r, g, b))
-
-    gray = Image.new("RGB", nm1.size, (128, 128, 128))
-    white = Image.new("RGB", nm1.size, (255, 255, 255))
-
-    h1 = ImageChops.multiply(nm1, gray)
-    h2 = ImageChops.multiply(ImageChops.subtract(white, nm2), gray)
-    r, g, b = ImageChops.add(h2, h1).split()
-
-    out = Image.merge("RGBA", (r, g, b, a))
-    out.save("C:/Projects/ffx/images/ffx_nm_final.tga")
-
+    sequence = find_sequence(fileMask)
+    if firstFrame is None:
+        firstFrame = sequence.first()
+
+    if findLoop:
+        if frameCount is None:
+            frameCount = sequence.run_length(firstFrame)
+        fileNames = sequence.file_names(frameCount, firstFrame)
+        dist = frame_distance_matrix(loop_features(fileNames, workers=workers))
+        offset, crossfade, cost = find_loop_point(dist, totalFrames, maxCrossfade)
+        print("{}: loop starts at frame {}, {} frame crossfade, seam error {:.4f}".format(
+            os.path.basename(outFile), firstFrame + offset, crossfade, cost))
+
+    start = firstFrame + offset
+    fileNames = sequence.file_names(totalFrames + crossfade, start)
+    frames = frame_source(fileNames[crossfade:totalFrames], frameSize)
+
+    # fade the head in from the frames rendered after the loop's last one
+    blended = None
+    if crossfade > 0:
+        head = load_frame_stack(fileNames[0:crossfade], frameSize, workers)
+        tail = load_frame_stack(fileNames[totalFrames:totalFrames + crossfade], frameSize, workers)
+        weights = ease(np.arange(1, crossfade + 1, dtype=np.float32) / (crossfade + 1), curve)
+        with Stage("crossfade"):
+            blended = crossfade_frames(head, tail, weights, normalMap=normalMap)
+        head = tail = None
+
+    # Make smooth borders: rowFilter=lambda pixels: apply_alpha_mask(pixels, get_alpha_mask(frameSize))
+    with AtlasWriter(outFile, frameSize, gridSize, 'RGBA') as atlas:
+        for i in xrange(0, totalFrames):
+            if i < crossfade:
+                atlas.paste(blended[i])
+            else:
+                atlas.paste(next(frames)[1])
+
+def grid_cells(pixels, gridSize):
+    # (H, W, c) atlas -> (rows, cols, h, w, c) view of its cells, no copy.
+    if pixels.ndim == 2:
+        pixels = pixels[:, :, None]
+    cols, rows = gridSize
+    h = pixels.shape[0] // rows
+    w = pixels.shape[1] // cols
+    cells = pixels[0:rows * h, 0:cols * w].reshape(rows, h, cols, w, pixels.shape[2])
+    return cells.swapaxes(1, 2)
+
+def sheet_cells(src, gridSize):
+    # Cell view of an open sheet (TgaImage or LoadedImage) plus the channel
+    # order that turns a cell into RGB(A); TgaImage.pixels is in file order.
+    cells = grid_cells(src.pixels, gridSize)
+    swizzle = None
+    if isinstance(src, TgaImage) and cells.shape[4] >= 3:
+        swizzle = (2, 1, 0, 3)[0:cells.shape[4]]
+    return cells, swizzle
+
+def cell_pixels(cells, cellIdx, swizzle=None):
+    cell = cells[cellIdx // cells.shape[1], cellIdx % cells.shape[1]]
+    if isinstance(cell, np.memmap):
+        # the caller's copy reads it from the mapped sheet
+        Profiler.add_bytes(bytesRead=cell.nbytes)
+    return cell if swizzle is None else cell[:, :, swizzle]
+
+def transform_cells(cells, rotate=0, flipX=False, flipY=False, transpose=False):
+    # Per-cell transforms on a (rows, cols, h, w, c) view, all strides only.
+    # rotate counts 90 degree steps counter-clockwise, as Image.rotate(90).
+    # Only the geometry matches: PIL premultiplies RGBA while rotating, so its
+    # RGB is off by up to 127 where 0 < alpha < 255 and zeroed where alpha is
+    # 0. rot90 moves texels unchanged; opaque sheets come out identical.
+    if transpose:
+        cells = cells.swapaxes(2, 3)
+    if rotate % 4:
+        cells = np.rot90(cells, rotate % 4, axes=(2, 3))
+    if flipX:
+        cells = cells[:, :, :, ::-1]
+    if flipY:
+        cells = cells[:, :, ::-1]
+    return cells
+
+def transform_grid(srcFile, dstFile, gridSize=(8, 8), rotate=0, flipX=False, flipY=False, transpose=False,
+                   order=None, newGridSize=None):
+    # Rewrites an existing sheet: per-cell rotate/flip/transpose, then the
+    # cells listed in 'order' (default: all, row-major) laid out on
+    # newGridSize (e.g. 8x8 -> 16x4). The source is viewed, not copied, when
+    # it's an uncompressed TGA; the result is encoded once, row by row.
+    tmpFile = staging_file(dstFile, [srcFile])
+    with open_image(srcFile) as src:
+        cells, swizzle = sheet_cells(src, gridSize)
+        cells = transform_cells(cells, rotate, flipX, flipY, transpose)
+        rows, cols, h, w, channels = cells.shape
+
+        if order is None:
+            order = range(rows * cols)
+        if newGridSize is None:
+            newGridSize = gridSize
+        if newGridSize[0] * newGridSize[1] < len(order):
+            raise ValueError("{} cells don't fit a {}x{} grid".format(len(order), newGridSize[0], newGridSize[1]))
+
+        with AtlasWriter(tmpFile, (w, h), newGridSize, 'RGBA') as atlas:
+            for cellIdx in order:
+                atlas.paste(cell_pixels(cells, cellIdx, swizzle))
+        # the views would keep srcFile mapped past close()
+        cells = None
+    finish_staging(tmpFile, dstFile)
+
+def split_sheet(srcFile, dstMask, gridSize=(8, 8), frameCount=None):
+    # Inverse of process_ffx: writes the cells back out as dstMask frames
+    # numbered from 0000. Cells are views into the sheet until encoded.
+    with open_image(srcFile) as src:
+        cells, swizzle = sheet_cells(src, gridSize)
+        if frameCount is None:
+            frameCount = gridSize[0] * gridSize[1]
+        for frameIdx in xrange(0, frameCount):
+            cell = np.ascontiguousarray(cell_pixels(cells, frameIdx, swizzle))
+            Image.fromarray(cell if cell.shape[2] > 1 else cell[:, :, 0]).save(dstMask.format(str(frameIdx).zfill(4)))
+
+def resample_weights(frameCount, newCount, loop=False):
+    # (newCount, frameCount) frame blending weights: a tent over the source
+    # frames each output frame spans (box-like when dropping frames, linear
+    # interpolation when adding them). Loops wrap around, sequences clamp.
+    step = float(frameCount) / newCount
+    radius = max(1.0, step)
+    centers = (np.arange(newCount) + 0.5) * step - 0.5
+    if not loop:
+        centers = np.clip(centers, 0.0, frameCount - 1.0)
+    offsets = np.arange(frameCount)[None, :] - centers[:, None]
+    if loop:
+        offsets = (offsets + frameCount * 0.5) % frameCount - frameCount * 0.5
+    weights = np.maximum(0.0, 1.0 - np.abs(offsets) / radius)
+    return (weights / weights.sum(axis=1, keepdims=True)).astype(np.float32)
+
+def blend_frames(frames, weights, normalMap=False):
+    # Weighted sum of same-size uint8 frames; normal maps are summed as
+    # decoded vectors and renormalized, alpha is always summed linearly.
+    acc = None
+    for frame, weight in zip(frames, weights):
+        value = frame.astype(np.float32)
+        if normalMap:
+            value[..., 0:3] = value[..., 0:3] * np.float32(2.0 / 255.0) - 1.0
+        acc = value * weight if acc is None else acc + value * weight
+
+    if not normalMap:
+        return np.clip(np.round(acc), 0.0, 255.0).astype(np.uint8)
+
+    out = np.empty(acc.shape, np.uint8)
+    v = acc[..., 0:3]
+    vLen = np.sqrt(np.einsum('...i,...i->...', v, v))[..., None]
+    out[..., 0:3] = encode_nm(np.where(vLen > 0.0, v / np.maximum(vLen, 1e-12), np.float32((0.0, 0.0, 1.0))))
+    if acc.shape[-1] > 3:
+        out[..., 3:] = np.clip(np.round(acc[..., 3:]), 0.0, 255.0)
+    return out
+
+def resample_sheet(srcFile, dstFile, gridSize=(8, 8), newCount=32, newGridSize=None, frameCount=None,
+                   loop=False, normalMap=False):
+    # Retimes a finished sheet to newCount frames with frame blending (e.g.
+    # 64 -> 32) and writes it on newGridSize (default: the source grid halved
+    # until it's as small as the new frame count allows, or doubled until it
+    # holds them when upsampling).
+    if frameCount is None:
+        frameCount = gridSize[0] * gridSize[1]
+    if newGridSize is None:
+        newGridSize = shrink_grid(grow_grid(gridSize, newCount), newCount)
+
+    weights = resample_weights(frameCount, newCount, loop)
+
+    tmpFile = staging_file(dstFile, [srcFile])
+    with open_image(srcFile) as src:
+        cells, swizzle = sheet_cells(src, gridSize)
+        frameSize = (cells.shape[3], cells.shape[2])
+        with AtlasWriter(tmpFile, frameSize, newGridSize, 'RGBA') as atlas:
+            for row in weights:
+                used = np.flatnonzero(row > 1e-6)
+                frames = [frame_pixels(cell_pixels(cells, i, swizzle), 'RGBA') for i in used]
+                with Stage("frame blend"):
+                    frame = blend_frames(frames, row[used], normalMap)
+                atlas.paste(frame)
+        # the views would keep srcFile mapped past close()
+        cells = frames = None
+    finish_staging(tmpFile, dstFile)
+
+    print("{}: {} frames resampled to {} on a {}x{} grid".format(
+        os.path.basename(dstFile), frameCount, newCount, newGridSize[0], newGridSize[1]))
+
+def mip_file_name(fileName, level):
+    base, ext = os.path.splitext(fileName)
+    return "{}.mip{}{}".format(base, level, ext)
+
+def build_sheet_mips(srcFile, gridSize=(8, 8), alphaRef=128, dilate=True, dilateThreshold=0, minCellSize=1):
+    # Offline mip chain for a finished sheet, written as <sheet>.mip0<ext>,
+    # <sheet>.mip1<ext>, ... Colour is first push-pull dilated into texels
+    # with alpha <= dilateThreshold, every level is filtered per cell (no
+    # bleeding between frames) and, with alphaRef, keeps level 0's alpha test
+    # coverage. Sheets are processed one grid row at a time.
+    with open_image(srcFile) as src:
+        cells, swizzle = sheet_cells(src, gridSize)
+        rows, cols = cells.shape[0:2]
+
+        writers = []
+        try:
+            for rowIdx in xrange(0, rows):
+                row = np.stack([frame_pixels(cell_pixels(cells, rowIdx * cols + col, swizzle), 'RGBA')
+                                for col in xrange(0, cols)])
+                if dilate:
+                    with Stage("dilate"):
+                        row = push_pull_fill(row, dilateThreshold)
+
+                with Stage("mip chain"):
+                    levels = mip_chain(row, alphaRef, minCellSize)
+                for level, levelCells in enumerate(levels):
+                    h, w = levelCells.shape[1:3]
+                    if level == len(writers):
+                        writers.append(open_image_writer(mip_file_name(srcFile, level), (cols * w, rows * h), 'RGBA'))
+                    # (cols, h, w, 4) -> one (h, cols * w, 4) band
+                    writers[level].write(levelCells.swapaxes(0, 1).reshape(h, cols * w, 4))
+        except:
+            for writer in writers:
+                writer.abort()
+            raise
+        for writer in writers:
+            writer.close()
+
+    print("{}: {} mip levels".format(os.path.basename(srcFile), len(writers)))
+    return len(writers)
+
+def sheet_bands(fileName, mode, bandRows=TILE_ROWS):
+    # Yields the sheet top to bottom as (rows, W, c) arrays in 'mode'.
+    with open_image(fileName) as src:
+        for top in xrange(0, src.size[1], bandRows):
+            yield frame_pixels(src.read((0, top, src.size[0], min(top + bandRows, src.size[1]))), mode)
+
+def encode_band(job):
+    pixels, format, quality = job
+    with Stage("block compress", format=format):
+        return encode_blocks(pixels, format, quality)
+
+def compress_sheet(srcFile, dstFile=None, format='BC3', quality='normal', mips=False, workers=None, poolType='process'):
+    # Block compresses a sheet into a DDS: BC1 (opaque) or BC3 for diffuse
+    # sheets, BC4 for masks, BC5 for normal maps (R and G). quality is
+    # 'fast', 'normal' or 'high'. With mips, the levels written by
+    # build_sheet_mips() go into the same file. Bands of BC_BAND_ROWS rows
+    # are encoded in parallel; returns the throughput in MPix/s.
+    if dstFile is None:
+        dstFile = os.path.splitext(srcFile)[0] + ".dds"
+
+    levels = [srcFile]
+    if mips:
+        levels = []
+        while os.path.isfile(mip_file_name(srcFile, len(levels))):
+            levels.append(mip_file_name(srcFile, len(levels)))
+        if not levels:
+            raise IOError("No mip levels for {}, run build_sheet_mips() first".format(srcFile))
+
+    sizes = [Image.open(level).size for level in levels]
+    mode = SOURCE_MODES[format]
+    jobs = ((pixels, format, quality) for level in levels for pixels in sheet_bands(level, mode, BC_BAND_ROWS))
+
+    startTime = time.time()
+    with DdsStreamWriter(dstFile, sizes[0], format, len(levels)) as dds:
+        for data in run_ordered(encode_band, jobs, workers, poolType):
+            dds.write(data)
+    elapsed = max(time.time() - startTime, 1e-6)
+
+    mpixPerSec = sum(w * h for w, h in sizes) / elapsed / 1e6
+    print("{}: {} {}x{}, {} level(s), {:.2f} MPix/s".format(
+        os.path.basename(dstFile), format, sizes[0][0], sizes[0][1], len(levels), mpixPerSec))
+    return mpixPerSec
+
+def rearrange_frames(srcFile="y:/art/source/particles/textures/fire_AAA_5.png",
+                     dstFile="y:/art/source/particles/textures/fire_AAA_5.tga", gridSize=(8, 8), rotate=1):
+    transform_grid(srcFile, dstFile, gridSize, rotate=rotate)
+
+def combine_normals_lut():
+    # lut[forward, inverted] == add(multiply(forward, 128), multiply(255 - inverted, 128))
+    # with ImageChops' truncating 8-bit arithmetic.
+    half = np.arange(256, dtype=np.int32) * 128 // 255
+    return np.minimum(half[:, None] + half[None, ::-1], 255).astype(np.uint8)
+
+def combine_normals(forward, inverted, lut):
+    # (..., 4) uint8 forward and inverted texels -> combined normals, alpha
+    # from the inverted ones; 'lut' is combine_normals_lut().
+    with Stage("normals"):
+        normals = np.empty(forward.shape, np.uint8)
+        normals[..., 0:3] = lut[forward[..., 0:3], inverted[..., 0:3]]
+        normals[..., 3] = inverted[..., 3]
+    return normals
+
+def combine_ffx_normals(fileMaskForward, fileMaskInverted, outFile=None):
+    # Forward and inverted light rig sheets -> one normal map; alpha comes from
+    # the inverted sheet. One table lookup per texel, one band of rows at a time.
+    if outFile is None:
+        outFile = os.path.join(os.path.dirname(output_name(fileMaskForward, "")), "ffx_nm_final.tga")
+
+    lut = combine_normals_lut()
+    srcFiles = [output_name(fileMaskForward, "combined"), output_name(fileMaskInverted, "combined")]
+    tmpFile = staging_file(outFile, srcFiles)
+
+    with open_image(srcFiles[0]) as nm1, open_image(srcFiles[1]) as nm2:
+        if nm1.size != nm2.size:
+            raise ValueError("Sheet sizes differ: {} and {}".format(nm1.size, nm2.size))
+
+        width, height = nm1.size
+        writer = open_image_writer(tmpFile, nm1.size, 'RGBA')
+        try:
+            for top in range(0, height, TILE_ROWS):
+                box = (0, top, width, min(top + TILE_ROWS, height))
+                forward = frame_pixels(nm1.read(box), 'RGBA')
+                inverted = frame_pixels(nm2.read(box), 'RGBA')
+                writer.write(combine_normals(forward, inverted, lut))
+        except:
+            writer.abort()
+            raise
+        writer.close()
+        # band arrays may be views of the mapped sheets
+        forward = inverted = None
+    finish_staging(tmpFile, outFile)
+
+
+class AtlasSink(object):
+    # build_sheets() sink: the cells of one source as an atlas, scaled by
+    # 'scale' (0.5 gives the half-res sheet).
+
+    def __init__(self, outFile, source, scale=1.0):
+        self.outFile = outFile
+        self.source = source
+        self.scale = scale
+        self.atlas = None
+
+    def start(self, frameSize, gridSize, frameCount):
+        self.cellSize = (max(1, int(round(frameSize[0] * self.scale))), max(1, int(round(frameSize[1] * self.scale))))
+        self.atlas = AtlasWriter(self.outFile, self.cellSize, gridSize, 'RGBA')
+
+    def add(self, frameIdx, cells):
+        cell = cells[self.source]
+        if self.scale != 1.0:
+            with Stage("thumbnail"):
+                cell = Image.fromarray(cell).resize(self.cellSize, Image.BOX)
+        self.atlas.paste(cell)
+
+    def close(self):
+        if self.atlas is not None:
+            self.atlas.close()
+
+    def abort(self):
+        if self.atlas is not None:
+            self.atlas.abort()
+
+class NormalsSink(object):
+    # build_sheets() sink: combine_ffx_normals() of two sources, cell by cell.
+
+    def __init__(self, outFile, forward, inverted):
+        self.outFile = outFile
+        self.forward = forward
+        self.inverted = inverted
+        self.lut = combine_normals_lut()
+        self.atlas = None
+
+    def start(self, frameSize, gridSize, frameCount):
+        self.atlas = AtlasWriter(self.outFile, frameSize, gridSize, 'RGBA')
+
+    def add(self, frameIdx, cells):
+        self.atlas.paste(combine_normals(cells[self.forward], cells[self.inverted], self.lut))
+
+    def close(self):
+        if self.atlas is not None:
+            self.atlas.close()
+
+    def abort(self):
+        if self.atlas is not None:
+            self.atlas.abort()
+
+class PreviewSink(object):
+    # build_sheets() sink: every 'step'-th frame of a source as a one row
+    # strip of thumbnails 'height' texels high.
+
+    def __init__(self, outFile, source, height=64, step=1):
+        self.outFile = outFile
+        self.source = source
+        self.height = height
+        self.step = step
+        self.atlas = None
+
+    def start(self, frameSize, gridSize, frameCount):
+        self.thumbSize = (max(1, frameSize[0] * self.height // frameSize[1]), self.height)
+        self.atlas = AtlasWriter(self.outFile, self.thumbSize, ((frameCount + self.step - 1) // self.step, 1), 'RGBA')
+
+    def add(self, frameIdx, cells):
+        if frameIdx % self.step == 0:
+            with Stage("thumbnail"):
+                thumb = Image.fromarray(cells[self.source]).resize(self.thumbSize, Image.BOX)
+            self.atlas.paste(thumb)
+
+    def close(self):
+        if self.atlas is not None:
+            self.atlas.close()
+
+    def abort(self):
+        if self.atlas is not None:
+            self.atlas.abort()
+
+def build_sheets(sources, sinks, gridSize=(8, 8), smoothBorders=False, borderFalloff=None, workers=1, poolType='thread'):
+    # Decode-once fan-out: 'sources' maps a name to a frame sequence (as in
+    # process_ffx), every frame of every source is decoded once and its cell
+    # handed to all 'sinks' (AtlasSink, NormalsSink, PreviewSink or anything
+    # with start/add/close/abort), which write their outputs in the same pass;
+    # abort() replaces close() when the pass fails.
+    #   build_sheets({'fwd': fwdMask, 'inv': invMask},
+    #                [NormalsSink(nmFile, 'fwd', 'inv'), PreviewSink(stripFile, 'fwd')], (8, 4))
+    names = sorted(sources.keys())
+    frameCount = gridSize[0] * gridSize[1]
+    fileNames = [find_sequence(sources[name]).file_names(frameCount) for name in names]
+    frameSize = Image.open(fileNames[0][0]).size
+    alphaMask = get_alpha_mask(frameSize, borderFalloff) if smoothBorders else None
+
+    jobs = [(frameIdx, [files[frameIdx] for files in fileNames], frameSize) for frameIdx in xrange(0, frameCount)]
+
+    try:
+        for sink in sinks:
+            sink.start(frameSize, gridSize, frameCount)
+        for frameIdx, frames in run_ordered(decode_frame_set, jobs, workers, poolType):
+            cells = dict((name, frame_cell(frame, frameSize, alphaMask)) for name, frame in zip(names, frames))
+            for sink in sinks:
+                sink.add(frameIdx, cells)
+    except:
+        for sink in sinks:
+            sink.abort()
+        raise
+    for sink in sinks:
+        sink.close()
+
+    print("{} frames of {} decoded once into {}".format(frameCount, ", ".join(names), ", ".join(
+        os.path.basename(sink.outFile) for sink in sinks)))
+
+def float_rgb(img):
+    return np.asarray(img.convert('RGB'), dtype=np.float32) / np.float32(255.0)
+
+def cloud_nm_channel(rgb):
+    # float32 RGB in [0, 1] -> one normal map channel in [0, 1] around the
+    # 127/255 neutral: half red minus half green, with 'too yellow' texels
+    # (both red and green above neutral) faded back to neutral.
+    neutral = np.float32(127.0 / 255.0)
+    r = rgb[..., 0]
+    g = rgb[..., 1]
+    yellowness = np.clip((np.minimum(r, g) - neutral) * 2.0, 0.0, 1.0)
+    value = np.clip(neutral + (r - g) * neutral, 0.0, 1.0)
+    return value + (neutral - value) * yellowness
 
 def generate_cloud_nm_channel(srcImg):
-
-    # channels
-    r, g, b, a = srcImg.split()
-
-    # helper images
-    gray = Image.new('L', srcImg.size, (127))
-    yellowRGB = Image.new('RGB', srcImg.size, (255, 255, 0))
-
-    # discard 'too yellow' values
-    oneMinusYellowness = ImageChops.difference(Image.merge('RGB', (r, g, b)), yellowRGB)
-    yR, yG, yB = oneMinusYellowness.split()
-    oneMinusYellowness = ImageChops.lighter(yR, yG)
-    yellowness = ImageChops.invert(oneMinusYellowness)
-    yellowness = ImageChops.lighter(yellowness, gray)
-    yellowness = ImageChops.subtract(yellowness, gray)
-    yellowness = ImageChops.add(yellowness, yellowness)
-    #yellowness.save("Y:/art/source/particles/textures/clouds/yellowness.png")
-
-    halfRed = ImageChops.multiply(r, gray) # 50% red
-    halfGreen = ImageChops.multiply(g, gray) # 50% green
-
-    # compose
-    dstImg = ImageChops.subtract(ImageChops.add(gray, halfRed), halfGreen)
-    dstImg = ImageChops.composite(gray, dstImg, yellowness)
-
-    return dstImg
-
-
-# TODO: normalize dstImg
-def generate_cloud_nm(horImg, vertImg):
-    r = generate_cloud_nm_channel(horImg)
-    g = generate_cloud_nm_channel(vertImg)
-    b = Image.new('L', horImg.size, (255))
-    dstImg = Image.merge('RGB', (r, g, b))
-    return dstImg
-
-
-def blend_nm_pixel(v1, v2):
-    v = [0.0, 0.0, 1.0]
-    x1 = ( float( v1[0] ) / 255.0 ) * 2.0 - 1.0
-    x2 = ( float( v2[0] ) / 255.0 ) * 2.0 - 1.0
-    v[0] = x1 + x2
-    y1 = ( float( v1[1] ) / 255.0 ) * 2.0 - 1.0
-    y2 = ( float( v2[1] ) / 255.0 ) * 2.0 - 1.0
-    v[1] = y1 + y2
-    z1 = ( float( v1[2] ) / 255.0 ) * 2.0 - 1.0
-    z2 = ( float( v2[2] ) / 255.0 ) * 2.0 - 1.0
-    v[2] = min( z1, z2 )
-
-    if v[2] < 0.0:
-        v = [0.0, 0.0, 1.0]
-
-    vLen = math.sqrt( v[0]*v[0] + v[1]*v[1] + v[2]*v[2] )
-    if vLen > 0.0:
-        v[0] /= vLen
-        v[1] /= vLen
-        v[2] /= vLen
-    else:
-        v = [0.0, 0.0, 1.0]
-
-    p = [127, 127, 255]
-    for i in range(0, 3):
-        p[i] = int( ( v[i] * 0.5 + 0.5 ) * 255.1 )
-
-    return ( p[0], p[1], p[2] )
+    channel = cloud_nm_channel(float_rgb(srcImg))
+    return Image.fromarray(np.round(channel * 255.0).astype(np.uint8), 'L')
+
+def generate_cloud_nm(horImg, vertImg, normalize=True):
+    x = cloud_nm_channel(float_rgb(horImg))
+    y = cloud_nm_channel(float_rgb(vertImg))
+
+    if not normalize:
+        b = np.full(x.shape, 255, np.uint8)
+        r, g = [np.round(c * 255.0).astype(np.uint8) for c in (x, y)]
+        return Image.fromarray(np.dstack((r, g, b)), 'RGB')
+
+    v = np.empty(x.shape + (3,), np.float32)
+    v[..., 0] = x * 2.0 - 1.0
+    v[..., 1] = y * 2.0 - 1.0
+    v[..., 2] = 1.0
+    v /= np.sqrt(np.einsum('...i,...i->...', v, v))[..., None]
+    return Image.fromarray(encode_nm(v), 'RGB')
+
+def generate_cloud_nm_file(job):
+    horFile, vertFile, outFile = job
+    generate_cloud_nm(Image.open(horFile), Image.open(vertFile)).save(outFile)
+    return outFile
+
+def generate_cloud_nm_batch(jobs, workers=None, poolType='process'):
+    # jobs: (horFile, vertFile, outFile) tuples, one texture per pool worker;
+    # workers=1 runs them in this process.
+    for outFile in run_ordered(generate_cloud_nm_file, jobs, workers, poolType):
+        print("{}: done".format(outFile))
+
+def generate_cloud_library(cloudDir, ext='.png', workers=None, poolType='process'):
+    # Every '<name>hor<ext>' with a matching '<name>vert<ext>' becomes
+    # '<name>nm<ext>' ('hor.png' + 'vert.png' -> 'cloud_nm.png').
+    jobs = []
+    for fileName in sorted(os.listdir(cloudDir)):
+        if not fileName.endswith('hor' + ext):
+            continue
+        prefix = fileName[0:-len('hor' + ext)]
+        vertFile = os.path.join(cloudDir, prefix + 'vert' + ext)
+        if os.path.isfile(vertFile):
+            outName = (prefix or 'cloud_') + 'nm' + ext
+            jobs.append((os.path.join(cloudDir, fileName), vertFile, os.path.join(cloudDir, outName)))
+    generate_cloud_nm_batch(jobs, workers, poolType)
+    return len(jobs)
+
+
+def encode_nm(v):
+    # Unit vectors -> uint8; the 255.1 scale is what the old per-pixel blend
+    # used, kept so sheets don't change.
+    return np.clip((v * 0.5 + 0.5) * 255.1, 0.0, 255.0).astype(np.uint8)
+
+def blend_nm_arrays(nm1, nm2):
+    # Sum of x and y, min of z, normalized: (..., 3+) uint8 in, (..., 3) uint8
+    # out. Works on single frames and on (N, H, W, 3) stacks.
+    nm1 = np.asarray(nm1)[..., 0:3]
+    nm2 = np.asarray(nm2)[..., 0:3]
+    shape = np.broadcast(nm1, nm2).shape
+    src = np.broadcast_to(nm1, shape).reshape(-1, 3)
+    dst = np.broadcast_to(nm2, shape).reshape(-1, 3)
+    out = np.empty(src.shape, np.uint8)
+
+    for start in range(0, src.shape[0], NM_BLEND_CHUNK):
+        end = start + NM_BLEND_CHUNK
+        v1 = src[start:end].astype(np.float32) * np.float32(2.0 / 255.0) - 1.0
+        v2 = dst[start:end].astype(np.float32) * np.float32(2.0 / 255.0) - 1.0
+
+        v = v1 + v2
+        v[:, 2] = np.minimum(v1[:, 2], v2[:, 2])
+
+        # negative z and zero length both fall back to the flat normal
+        vLen = np.sqrt(np.einsum('ij,ij->i', v, v))
+        flat = (v[:, 2] < 0.0) | (vLen <= 0.0)
+        v[flat] = (0.0, 0.0, 1.0)
+        vLen[flat] = 1.0
+        v /= vLen[:, None]
+
+        out[start:end] = encode_nm(v)
+
+    return out.reshape(shape)
+
+
+def rgb_array(img):
+    if img.mode not in ('RGB', 'RGBA'):
+        img = img.convert('RGB')
+    return np.asarray(img)[..., 0:3]
 
 
 def blend_normal_maps(srcImg, dstImg):
-    srcImg = Image.merge('RGB', srcImg.split()[0:3])
-    dstImg = Image.merge('RGB', dstImg.split()[0:3])
-
-    outImg = Image.new('RGB', srcImg.size, (0, 0, 0))
-
-    srcPixels = srcImg.load()
-    dstPixels = dstImg.load()
-    outPixels = outImg.load()
-
-    for i in range(0, outImg.size[0]):
-        for j in range(0, outImg.size[1]):
-            p1 = srcPixels[i, j]
-            p2 = dstPixels[i, j]
-            outPixels[i, j] = blend_nm_pixel(p1, p2)
-
-    return outImg
+    return Image.fromarray(blend_nm_arrays(rgb_array(srcImg), rgb_array(dstImg)), 'RGB')
 
 
 def crossfade_spline(x):
-    y = math.sin(x * math.pi / 2.0)
+    y = np.sin(x * math.pi / 2.0)
     return y
 
 
-def make_grid_frames():
-    frame = Image.open("D:/Projects/StaticWater_Rend_NM/0001.png")
-    flat = Image.new('RGBA', frame.size, (127, 127, 255, 255))
-
-    frameCount = 64
-    altFrameCount = 32
-
-    for i in range(1, frameCount + 1):
-        frame = Image.open("D:/Projects/StaticWater_Rend_NM/{}.png".format(str(i).zfill(4)))
-        if i <= altFrameCount:
-            alpha = float(i) / float(altFrameCount)
-            altFrame = Image.open("D:/Projects/StaticWater_Rend_NM/{}.png".format(str(frameCount + i).zfill(4)))
-            altFrame = ImageChops.blend(flat, altFrame, crossfade_spline(1.0 - alpha))
-            frame = ImageChops.blend(flat, frame, crossfade_spline(alpha))
-            frame = blend_normal_maps(frame, altFrame)
-        #frame = Image.merge('RGB', frame.split()[0:3])
-        frame = blend_normal_maps(frame, flat)
-        frame.save("D:/Projects/StaticWater_Fade2/{}.png".format(str(i).zfill(4)))
-
-
-def make_grid():
-
-    frame = Image.open("D:/Projects/StaticWater_Fade2/0001.png")
-    outImg = Image.new('RGB', (8 * frame.size[0], 8 * frame.size[1]))
-
-    frameNum = 1
-    for j in range(0, 8):
-        for i in range(0, 8):
-            frame = Image.open("D:/Projects/StaticWater_Fade2/{}.png".format(str(frameNum).zfill(4)))
-            location = (i * frame.size[0], j * frame.size[1])
-            outImg.paste(frame, location)
-            frameNum += 1
-
-    outImg.save("y:/art/source/particles/textures/grid2.png")
+EASING_CURVES = {
+    'linear': lambda t: t,
+    'sine': crossfade_spline,
+    'smoothstep': lambda t: t * t * (3.0 - 2.0 * t),
+    'cosine': lambda t: 0.5 - 0.5 * np.cos(t * math.pi),
+}
+
+# Frames per float32 chunk in crossfade_frames().
+CROSSFADE_CHUNK = 8
+
+def ease(t, curve='linear'):
+    return EASING_CURVES[curve](np.asarray(t, np.float32)).astype(np.float32)
+
+def load_frame_stack(fileNames, frameSize, workers=1):
+    # (N, h, w, 4) uint8 stack of frames, each thumbnailed into a cell.
+    stack = np.zeros((len(fileNames), frameSize[1], frameSize[0], 4), np.uint8)
+    for i, frame in frame_source(fileNames, frameSize, workers):
+        stack[i] = frame_cell(frame, frameSize)
+    return stack
+
+def crossfade_frames(head, tail, headWeights, tailWeights=None, normalMap=False):
+    # Blends two (N, h, w, c) uint8 windows with per-frame weights broadcast
+    # over each frame; tailWeights defaults to 1 - headWeights. Normal maps
+    # are mixed as decoded vectors and renormalized instead of lerped in RGB,
+    # alpha (if any) is always mixed linearly.
+    headWeights = np.asarray(headWeights, np.float32)
+    tailWeights = 1.0 - headWeights if tailWeights is None else np.asarray(tailWeights, np.float32)
+    out = np.empty(head.shape, np.uint8)
+
+    for start in range(0, head.shape[0], CROSSFADE_CHUNK):
+        chunk = slice(start, start + CROSSFADE_CHUNK)
+        wh = headWeights[chunk, None, None, None]
+        wt = tailWeights[chunk, None, None, None]
+        h = head[chunk].astype(np.float32)
+        t = tail[chunk].astype(np.float32)
+
+        if not normalMap:
+            out[chunk] = np.clip(np.round(h * wh + t * wt), 0.0, 255.0)
+            continue
+
+        scale = np.float32(2.0 / 255.0)
+        v = (h[..., 0:3] * scale - 1.0) * wh + (t[..., 0:3] * scale - 1.0) * wt
+        vLen = np.sqrt(np.einsum('...i,...i->...', v, v))[..., None]
+        v = np.where(vLen > 0.0, v / np.maximum(vLen, 1e-12), np.float32((0.0, 0.0, 1.0)))
+        out[chunk][..., 0:3] = encode_nm(v)
+        if head.shape[-1] == 4:
+            out[chunk][..., 3] = np.clip(np.round(h[..., 3] * wh[..., 0] + t[..., 3] * wt[..., 0]), 0.0, 255.0)
+
+    return out
+
+
+def make_grid_frames(srcMask="D:/Projects/StaticWater_Rend_NM/{}.png", dstMask="D:/Projects/StaticWater_Fade2/{}.png",
+                     frameCount=64, altFrameCount=32, curve='sine', workers=None, firstFrame=1):
+    # The first altFrameCount frames fade in from the ones rendered after
+    # frameCount, giving a frameCount long normal map loop of the frames from
+    # firstFrame (None: the sequence's first). Output frames keep the source
+    # numbering and padding.
+    sequence = find_sequence(srcMask)
+    if firstFrame is None:
+        firstFrame = sequence.first()
+    fileNames = sequence.file_names(frameCount + altFrameCount, firstFrame)
+    frameSize = Image.open(fileNames[0]).size
+    flat = np.array((127, 127, 255), np.uint8)
+
+    alpha = np.arange(1, altFrameCount + 1, dtype=np.float32) / altFrameCount
+    head = load_frame_stack(fileNames[0:altFrameCount], frameSize, workers)
+    tail = load_frame_stack(fileNames[frameCount:frameCount + altFrameCount], frameSize, workers)
+    with Stage("crossfade"):
+        blended = crossfade_frames(head, tail, ease(alpha, curve), ease(1.0 - alpha, curve), normalMap=True)
+    head = tail = None
+
+    frames = frame_source(fileNames[altFrameCount:frameCount], workers=workers)
+    for i in range(0, frameCount):
+        if i < altFrameCount:
+            frame = blended[i]
+        else:
+            frame = next(frames)[1]
+        with Stage("normals"):
+            frame = blend_nm_arrays(frame_pixels(frame, 'RGB'), flat)
+        with Stage("encode image"):
+            Image.fromarray(frame, 'RGB').save(dstMask.format(str(firstFrame + i).zfill(sequence.padding)))
+
+
+def make_grid(srcMask="D:/Projects/StaticWater_Fade2/{}.png", outFile="y:/art/source/particles/textures/grid2.png",
+              gridSize=(8, 8), foldDuplicates=False, foldThreshold=0.0):
+
+    fileNames = find_sequence(srcMask).file_names(gridSize[0] * gridSize[1])
+    frameSize = Image.open(fileNames[0]).size
+
+    if foldDuplicates:
+        cells = [frame for frameIdx, frame in frame_source(fileNames)]
+        write_folded_sheet(outFile, cells, frameSize, gridSize, foldThreshold, 'RGB')
+        return
+
+    with AtlasWriter(outFile, frameSize, gridSize, 'RGB') as atlas:
+        for frameIdx, frame in frame_source(fileNames):
+            atlas.paste(frame)
 
 
 if __name__ == "__main__":
-    if len(sys.argv) > 1:
-        cmd = sys.argv[1]
-        print("{}:\n\t{}".format(__file__, cmd.replace("\n", "\n\t")))
-        exec(cmd)
-    else:
-        make_grid_frames()
-        make_grid()
-        #horImg = Image.open("Y:/art/source/particles/textures/clouds/hor.png")
-        #vertImg = Image.open("Y:/art/source/particles/textures/clouds/vert.png")
-        #dstImg = generate_cloud_nm(horImg, vertImg)
-        #dstImg.save("Y:/art/source/particles/textures/clouds/cloud_nm.png")
-        #process_ffx("C:/Projects/ffx/images/ffx_d.{}.tga", (8, 4))
-        #process_ffx("C:/Projects/ffx/images/ffx_nm_forward.{}.tga", (8, 4))
-        #process_ffx("C:/Projects/ffx/images/ffx_nm_inverted.{}.tga", (8, 4))
-        #combine_ffx_normals("C:/Projects/ffx/images/ffx_nm_forward.{}.tga", "C:/Projects/ffx/images/ffx_nm_inverted.{}.tga")
-        pass
+    import argparse
+    import BatchManifest
+
+    parser = argparse.ArgumentParser(description="Builds the sprite sheets listed in a JSON/TOML batch manifest.")
+    parser.add_argument("manifest", help="manifest file, see BatchManifest.py for the format")
+    parser.add_argument("--jobs", type=int, default=None, help="jobs run at once (default: all cores)")
+    parser.add_argument("--dry-run", action="store_true", help="validate and list the jobs without running them")
+    parser.add_argument("--profile", nargs="?", const="", default=None, metavar="BASE",
+                        help="write a stage profile to BASE.json and BASE.trace.json (default: <manifest>.profile)")
+    options = parser.parse_args()
+
+    profile = options.profile
+    if profile == "":
+        profile = os.path.splitext(options.manifest)[0] + ".profile"
+
+    try:
+        failed = BatchManifest.run_manifest(options.manifest, options.jobs, options.dry_run, profile)
+    except ValueError as e:
+        print(e)
+        sys.exit(2)
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,312 @@
+import os
+import sys
+import time
+import stat
+import errno
+import getpass
+import binascii
+import tempfile
+import traceback
+import subprocess
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Listener, Client
+
+import Profiler
+
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+# Long-lived GridMaker process. Clients (SceneTweaks in Maya) send job
+# messages instead of starting C:\Python27\python.exe and exec'ing a string
+# per sheet, so interpreter/PIL startup is paid once and the alpha mask and
+# frame caches stay warm. Only the client half is used from Maya, so nothing
+# here imports numpy or PIL at module level.
+#
+# The address and the log are per user, and both ends prove they know a
+# random key kept in a file only this user can read. Messages are pickles,
+# so the key is what keeps another local user from serving or sending them:
+# the handshake happens before anything is unpickled.
+#
+# Request: {'job': name, 'args': [...], 'kwargs': {...}}
+# Reply:   {'ok': bool, 'result': ..., 'error': str, 'log': str, 'seconds': float,
+#           'profile': Profiler report base path or None}
+
+if sys.platform == 'win32':
+    # the user profile is already private to its owner
+    USER_DIR = os.path.join(os.environ.get('LOCALAPPDATA') or os.path.expanduser("~"), "vfxutils")
+    ADDRESS = r"\\.\pipe\vfxutils_gridmaker_" + getpass.getuser()
+    FAMILY = 'AF_PIPE'
+    PYTHON_EXE = "C:\\Python27\\python.exe"
+else:
+    USER_DIR = os.path.join(tempfile.gettempdir(), "vfxutils-{}".format(os.getuid()))
+    ADDRESS = os.path.join(USER_DIR, "gridmaker.sock")
+    FAMILY = 'AF_UNIX'
+    PYTHON_EXE = sys.executable
+
+# Random per user key, created on first use.
+AUTHKEY_FILE = os.path.join(USER_DIR, "gridmaker.key")
+AUTHKEY_BYTES = 32
+
+# A detached worker has no console; its output goes here.
+LOG_FILE = os.path.join(USER_DIR, "gridmaker.log")
+
+# Decoded frames the worker keeps between jobs.
+FRAME_CACHE_BYTES = 512 << 20
+
+# Seconds a client waits for a freshly started worker to listen.
+STARTUP_TIMEOUT = 30.0
+
+# GridMaker functions a job may name.
+JOBS = (
+    'process_ffx', 'process_ffx_packed', 'process_ffx_loop', 'process_ffx_motion', 'process_ffx_sdf',
+    'combine_ffx_normals', 'build_sheets', 'pack_channels', 'transform_grid', 'rearrange_frames',
+    'split_sheet', 'resample_sheet', 'build_sheet_mips', 'compress_sheet', 'generate_cloud_library',
+    'make_grid_frames', 'make_grid',
+)
+
+# build_sheets() sinks travel as [className, [args...]].
+SINKS = ('AtlasSink', 'NormalsSink', 'PreviewSink')
+
+
+def user_dir():
+    # USER_DIR, created readable by this user only. An existing one must be
+    # ours and private, or someone else could swap the socket or the key.
+    try:
+        os.makedirs(USER_DIR, 0o700)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+    if sys.platform != 'win32':
+        info = os.lstat(USER_DIR)
+        if not stat.S_ISDIR(info.st_mode) or info.st_uid != os.getuid() or info.st_mode & 0o077:
+            raise RuntimeError("{} must be a directory owned by this user with mode 0700".format(USER_DIR))
+    return USER_DIR
+
+
+def load_authkey():
+    # The user's key, generated into a 0600 file the first time.
+    user_dir()
+    try:
+        fd = os.open(AUTHKEY_FILE, os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, 'O_BINARY', 0), 0o600)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+    else:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(binascii.hexlify(os.urandom(AUTHKEY_BYTES)))
+
+    for attempt in range(0, 50):
+        # another process may have created the file and not written it yet
+        with open(AUTHKEY_FILE, 'rb') as f:
+            key = f.read().strip()
+        if len(key) == 2 * AUTHKEY_BYTES:
+            return key
+        time.sleep(0.02)
+    raise RuntimeError("{} doesn't hold a valid key; delete it to make a new one".format(AUTHKEY_FILE))
+
+
+class TeeOutput(object):
+    # Captures a job's prints for the reply and still shows them in the worker.
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.buffer = StringIO()
+
+    def write(self, text):
+        self.stream.write(text)
+        self.buffer.write(text)
+
+    def flush(self):
+        self.stream.flush()
+
+
+def run_job(gridMaker, message):
+    job = message.get('job')
+    args = list(message.get('args', ()))
+    kwargs = dict(message.get('kwargs', {}))
+
+    if job == 'ping':
+        return os.getpid()
+    if job == 'stats':
+        return {'frames': len(gridMaker.g_frameCache), 'frameBytes': gridMaker.g_frameCacheBytes,
+                'alphaMasks': len(gridMaker.g_alphaMaskCache)}
+    if job not in JOBS:
+        raise ValueError("Unknown job '{}'".format(job))
+
+    if job == 'build_sheets':
+        sinks = kwargs['sinks'] if 'sinks' in kwargs else args[1]
+        for spec in sinks:
+            if spec[0] not in SINKS:
+                raise ValueError("Unknown sink '{}'".format(spec[0]))
+        sinks = [getattr(gridMaker, name)(*sinkArgs) for name, sinkArgs in sinks]
+        if 'sinks' in kwargs:
+            kwargs['sinks'] = sinks
+        else:
+            args[1] = sinks
+
+    with Profiler.Stage(job):
+        return getattr(gridMaker, job)(*args, **kwargs)
+
+
+def serve(address=ADDRESS, frameCacheBytes=FRAME_CACHE_BYTES, profileDir=None):
+    # Runs jobs one at a time until a 'shutdown' message arrives; other
+    # clients wait in accept(). GridMaker still fans each job out over its
+    # own pools. With profileDir every job writes a Profiler report there.
+    import GridMaker
+    GridMaker.set_frame_cache_limit(frameCacheBytes)
+
+    if FAMILY == 'AF_UNIX' and os.path.exists(address):
+        # left behind by a worker that didn't exit cleanly
+        if ping(address):
+            raise RuntimeError("A GridMaker worker is already listening on {}".format(address))
+        os.remove(address)
+
+    listener = Listener(address, FAMILY, authkey=load_authkey())
+    print("GridWorker {}: listening on {}".format(os.getpid(), address))
+    running = True
+    try:
+        while running:
+            try:
+                conn = listener.accept()
+            except (AuthenticationError, IOError, EOFError) as e:
+                # a client without the key, or one that hung up mid handshake
+                print("GridWorker {}: rejected a connection: {}".format(os.getpid(), e))
+                continue
+            try:
+                while True:
+                    message = conn.recv()
+                    if message.get('job') == 'shutdown':
+                        running = False
+                        conn.send({'ok': True, 'result': None, 'error': None, 'log': "", 'seconds': 0.0, 'profile': None})
+                        break
+                    conn.send(handle(GridMaker, message, profileDir))
+            except EOFError:
+                pass
+            except (IOError, OSError) as e:
+                # the client hung up mid job (broken pipe, reset); wait for the next one
+                print("GridWorker {}: lost a client: {}".format(os.getpid(), e))
+            finally:
+                conn.close()
+    finally:
+        listener.close()
+        print("GridWorker {}: stopped".format(os.getpid()))
+
+
+def handle(gridMaker, message, profileDir=None):
+    startTime = time.time()
+    profiled = profileDir is not None and message.get('job') not in ('ping', 'stats')
+    if profiled:
+        Profiler.start_profile(message.get('job'))
+    output = TeeOutput(sys.stdout)
+    sys.stdout = output
+    try:
+        reply = {'ok': True, 'result': run_job(gridMaker, message), 'error': None}
+    except Exception:
+        reply = {'ok': False, 'result': None, 'error': traceback.format_exc()}
+        sys.stderr.write(reply['error'])
+    finally:
+        sys.stdout = output.stream
+    reply['log'] = output.buffer.getvalue()
+    reply['seconds'] = time.time() - startTime
+
+    reply['profile'] = None
+    if profiled:
+        profile = Profiler.stop_profile()
+        reply['profile'] = os.path.join(profileDir, "{}_{}_{:03d}".format(
+            message.get('job'), time.strftime("%Y%m%d_%H%M%S", time.localtime(startTime)), int(startTime * 1000) % 1000))
+        profile.write(reply['profile'])
+    return reply
+
+
+def connect(address=ADDRESS):
+    return Client(address, FAMILY, authkey=load_authkey())
+
+
+def ping(address=ADDRESS):
+    try:
+        conn = connect(address)
+    except (IOError, OSError, EOFError):
+        return False
+    try:
+        conn.send({'job': 'ping'})
+        return conn.recv().get('ok', False)
+    except (IOError, OSError, EOFError):
+        return False
+    finally:
+        conn.close()
+
+
+def start_worker(address=ADDRESS, python=PYTHON_EXE, profileDir=None):
+    # Starts a detached worker unless one already answers, then waits for it.
+    # A worker that is already running keeps its own profiling setting.
+    if ping(address):
+        return
+    command = [python, os.path.abspath(__file__).replace(".pyc", ".py"), "--serve", "--address", address]
+    if profileDir is not None:
+        command += ["--profile", profileDir]
+    flags = 0x00000008 if sys.platform == 'win32' else 0 # DETACHED_PROCESS
+    user_dir()
+    with open(LOG_FILE, 'a') as log:
+        subprocess.Popen(command,
+                         stdout=log, stderr=subprocess.STDOUT, creationflags=flags,
+                         close_fds=sys.platform != 'win32')
+
+    deadline = time.time() + STARTUP_TIMEOUT
+    while not ping(address):
+        if time.time() > deadline:
+            raise RuntimeError("GridMaker worker didn't start listening on {}".format(address))
+        time.sleep(0.2)
+
+
+def submit(job, *args, **kwargs):
+    # Runs one GridMaker job in the worker (started on first use) and returns
+    # its result; the job's output is echoed to this process' stdout.
+    address = kwargs.pop('address', ADDRESS)
+    start_worker(address)
+
+    conn = connect(address)
+    try:
+        conn.send({'job': job, 'args': list(args), 'kwargs': kwargs})
+        reply = conn.recv()
+    finally:
+        conn.close()
+
+    sys.stdout.write(reply['log'])
+    if not reply['ok']:
+        raise RuntimeError("GridMaker job '{}' failed:\n{}".format(job, reply['error']))
+    sys.stdout.write("{}: {:.2f}s in worker\n".format(job, reply['seconds']))
+    if reply.get('profile'):
+        sys.stdout.write("{}: profile in {}.json\n".format(job, reply['profile']))
+    return reply['result']
+
+
+def shutdown(address=ADDRESS):
+    if not ping(address):
+        return False
+    conn = connect(address)
+    try:
+        conn.send({'job': 'shutdown'})
+        conn.recv()
+    finally:
+        conn.close()
+    return True
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Long-lived GridMaker worker.")
+    parser.add_argument("--serve", action="store_true", help="run the worker (the default)")
+    parser.add_argument("--stop", action="store_true", help="ask a running worker to exit")
+    parser.add_argument("--address", default=ADDRESS)
+    parser.add_argument("--profile", metavar="DIR", default=None, help="write a stage profile of every job to DIR")
+    options = parser.parse_args()
+
+    if options.stop:
+        shutdown(options.address)
+    else:
+        if options.profile is not None and not os.path.isdir(options.profile):
+            os.makedirs(options.profile)
+        serve(options.address, profileDir=options.profile)
@@ -0,0 +1,88 @@
+import numpy as np
+
+# All functions work on (n, h, w, c) stacks of cells, so nothing is ever
+# filtered across a cell border.
+
+
+def pad_even(pixels):
+    # Zero-pads h and w to even sizes (zero weight in push-pull).
+    padH, padW = pixels.shape[1] % 2, pixels.shape[2] % 2
+    if padH or padW:
+        pixels = np.pad(pixels, ((0, 0), (0, padH), (0, padW), (0, 0)), 'constant')
+    return pixels
+
+
+def sum_2x2(pixels):
+    n, h, w, c = pixels.shape
+    return pixels.reshape(n, h // 2, 2, w // 2, 2, c).sum(axis=(2, 4))
+
+
+def expand_2x(pixels, shape):
+    # Nearest 2x upsample cropped to the finer level's (h, w).
+    pixels = np.repeat(np.repeat(pixels, 2, axis=1), 2, axis=2)
+    return pixels[:, 0:shape[1], 0:shape[2]]
+
+
+def push_pull_fill(cells, threshold=0):
+    # uint8 RGBA cells -> copy with the RGB under texels whose alpha is at or
+    # below 'threshold' filled from the nearest covered colour, so filtering
+    # and mips don't pull black into the edges. Pull averages covered colour
+    # down to 1x1, push hands the coarser colour back to every hole.
+    weight = (cells[..., 3:4] > threshold).astype(np.float32)
+    color = cells[..., 0:3].astype(np.float32)
+
+    levels = []
+    while color.shape[1] > 1 or color.shape[2] > 1:
+        levels.append((color, weight))
+        weightSum = sum_2x2(pad_even(weight))
+        colorSum = sum_2x2(pad_even(color * weight))
+        color = colorSum / np.maximum(weightSum, np.float32(1e-6))
+        weight = np.minimum(weightSum, 1.0)
+
+    for fineColor, fineWeight in reversed(levels):
+        color = fineColor * fineWeight + expand_2x(color, fineColor.shape) * (1.0 - fineWeight)
+
+    out = cells.copy()
+    holes = cells[..., 3] <= threshold
+    out[..., 0:3][holes] = np.clip(np.round(color[holes]), 0.0, 255.0).astype(np.uint8)
+    return out
+
+
+def alpha_coverage(alpha, alphaRef):
+    # Fraction of texels per cell that pass an alpha test against alphaRef.
+    return (alpha > alphaRef).reshape(alpha.shape[0], -1).mean(axis=1)
+
+
+def scale_alpha_to_coverage(alpha, coverage, alphaRef):
+    # Scales each cell's float alpha so that the same fraction of its texels
+    # passes the alpha test as in the top mip: the texel that has to be the
+    # last one to pass is mapped just above alphaRef.
+    n = alpha.shape[0]
+    texels = np.sort(alpha.reshape(n, -1), axis=1)
+    texelCount = texels.shape[1]
+
+    keep = np.clip(np.round(coverage * texelCount).astype(np.intp), 0, texelCount)
+    pivot = texels[np.arange(n), np.clip(texelCount - keep, 0, texelCount - 1)]
+    scale = np.where(keep > 0,
+                     (alphaRef + 1.0) / np.maximum(pivot, 1e-3),
+                     np.minimum(1.0, alphaRef / np.maximum(texels[:, -1], 1e-3)))
+    return np.clip(alpha * scale.astype(np.float32)[:, None, None], 0.0, 255.0)
+
+
+def mip_chain(cells, alphaRef=None, minCellSize=1):
+    # uint8 RGBA cells -> list of uint8 cell stacks, level 0 first, each a 2x2
+    # box filter of the previous one, until a cell side would be odd or fall
+    # below minCellSize. With alphaRef, every level's alpha is rescaled to keep
+    # the top level's alpha test coverage (the unscaled chain is what gets
+    # filtered further).
+    levels = [cells]
+    coverage = alpha_coverage(cells[..., 3], alphaRef) if alphaRef is not None else None
+
+    level = cells.astype(np.float32)
+    while level.shape[1] % 2 == 0 and level.shape[2] % 2 == 0 and min(level.shape[1:3]) // 2 >= minCellSize:
+        level = sum_2x2(level) * np.float32(0.25)
+        out = level.copy()
+        if coverage is not None:
+            out[..., 3] = scale_alpha_to_coverage(level[..., 3], coverage, alphaRef)
+        levels.append(np.clip(np.round(out), 0.0, 255.0).astype(np.uint8))
+    return levels
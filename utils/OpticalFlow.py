@@ -0,0 +1,133 @@
+import numpy as np
+
+# Rec. 601 luma weights for the matching image.
+LUMA = np.float32((0.299, 0.587, 0.114))
+
+
+def match_image(pixels):
+    # uint8 frame -> float32 intensity to match on. With alpha, premultiplied
+    # luma and coverage are averaged so flat-coloured smoke still has edges.
+    pixels = np.asarray(pixels)
+    if pixels.ndim == 2:
+        return pixels.astype(np.float32)
+    if pixels.shape[2] < 3:
+        return pixels[:, :, 0].astype(np.float32)
+
+    luma = np.dot(pixels[:, :, 0:3].astype(np.float32), LUMA)
+    if pixels.shape[2] == 3:
+        return luma
+    alpha = pixels[:, :, 3].astype(np.float32)
+    return 0.5 * (luma * alpha * np.float32(1.0 / 255.0) + alpha)
+
+
+def downsample(img):
+    # 2x2 box; an odd last row/column is dropped
+    h, w = img.shape[0] // 2 * 2, img.shape[1] // 2 * 2
+    return 0.25 * (img[0:h:2, 0:w:2] + img[1:h:2, 0:w:2] + img[0:h:2, 1:w:2] + img[1:h:2, 1:w:2])
+
+
+def upsample_flow(flow, shape):
+    # Coarse level flow -> 'shape' level: doubled in size and in length.
+    flow = np.repeat(np.repeat(flow, 2, axis=0), 2, axis=1) * 2.0
+    padH, padW = max(0, shape[0] - flow.shape[0]), max(0, shape[1] - flow.shape[1])
+    if padH or padW:
+        flow = np.pad(flow, ((0, padH), (0, padW), (0, 0)), 'edge')
+    return flow[0:shape[0], 0:shape[1]]
+
+
+def box_filter(img, radius):
+    # Mean over a (2 * radius + 1)^2 window with clamped edges, O(1) per texel.
+    size = 2 * radius + 1
+    padded = np.pad(img, radius, 'edge').astype(np.float64)
+
+    acc = np.zeros((padded.shape[0] + 1, padded.shape[1]))
+    np.cumsum(padded, axis=0, out=acc[1:])
+    acc = acc[size:] - acc[:-size]
+
+    rows = np.zeros((acc.shape[0], acc.shape[1] + 1))
+    np.cumsum(acc, axis=1, out=rows[:, 1:])
+    return ((rows[:, size:] - rows[:, :-size]) / (size * size)).astype(np.float32)
+
+
+def warp(img, flow):
+    # img sampled bilinearly at p + flow(p), clamped to the edges.
+    h, w = img.shape
+    ys, xs = np.mgrid[0:h, 0:w].astype(np.float32)
+    x = np.clip(xs + flow[:, :, 0], 0.0, w - 1.0)
+    y = np.clip(ys + flow[:, :, 1], 0.0, h - 1.0)
+
+    x0 = np.floor(x).astype(np.intp)
+    y0 = np.floor(y).astype(np.intp)
+    x1 = np.minimum(x0 + 1, w - 1)
+    y1 = np.minimum(y0 + 1, h - 1)
+    fx = x - x0
+    fy = y - y0
+
+    top = img[y0, x0] * (1.0 - fx) + img[y0, x1] * fx
+    bottom = img[y1, x0] * (1.0 - fx) + img[y1, x1] * fx
+    return top * (1.0 - fy) + bottom * fy
+
+
+def shift(img, dx, dy):
+    # img sampled at p + (dx, dy), clamped to the edges.
+    h, w = img.shape
+    rows = np.clip(np.arange(h) + dy, 0, h - 1)
+    cols = np.clip(np.arange(w) + dx, 0, w - 1)
+    return img[rows][:, cols]
+
+
+def match_level(src, dst, flow, radius=2, window=3, penalty=1.0):
+    # One pyramid level of block matching: 'dst' is warped by the predicted
+    # flow and every integer residual within 'radius' is scored by the mean
+    # squared difference over a (2 * window + 1)^2 block around each texel.
+    # Ties go to the smallest residual (so flat areas keep the prediction),
+    # then the winner is refined to subpixel with a parabola per axis.
+    side = 2 * radius + 1
+    warped = warp(dst, flow)
+
+    costs = np.empty((side * side, src.size), np.float32)
+    for dy in xrange(-radius, radius + 1):
+        for dx in xrange(-radius, radius + 1):
+            diff = shift(warped, dx, dy) - src
+            cost = box_filter(diff * diff, window) + penalty * (dx * dx + dy * dy)
+            costs[(dy + radius) * side + dx + radius] = cost.ravel()
+
+    best = np.argmin(costs, axis=0)
+    texels = np.arange(src.size)
+    bx = best % side
+    by = best // side
+    center = costs[best, texels]
+
+    def subpixel(pos, step):
+        # parabola through the costs at pos - 1, pos, pos + 1 along one axis
+        inside = (pos > 0) & (pos < side - 1)
+        lo = costs[np.where(inside, best - step, best), texels]
+        hi = costs[np.where(inside, best + step, best), texels]
+        curve = lo - 2.0 * center + hi
+        offset = np.where(inside & (curve > 0.0), (lo - hi) / np.maximum(2.0 * curve, 1e-6), 0.0)
+        return np.clip(offset, -0.5, 0.5)
+
+    residual = np.empty(flow.shape, np.float32)
+    residual[:, :, 0] = (bx - radius + subpixel(bx, 1)).reshape(src.shape)
+    residual[:, :, 1] = (by - radius + subpixel(by, side)).reshape(src.shape)
+    return flow + residual
+
+
+def estimate_flow(src, dst, radius=2, window=3, minSize=16, smooth=2):
+    # Dense (h, w, 2) float32 flow in pixels from 'src' to 'dst' (2D float
+    # images, see match_image()) such that dst(p + flow(p)) ~ src(p).
+    # Coarse to fine block matching over a 2x pyramid that stops at 'minSize'
+    # texels, so motion up to about radius * 2^levels pixels is found.
+    pyramid = [(src, dst)]
+    while min(pyramid[-1][0].shape) >= 2 * minSize:
+        pyramid.append((downsample(pyramid[-1][0]), downsample(pyramid[-1][1])))
+
+    flow = np.zeros(pyramid[-1][0].shape + (2,), np.float32)
+    for levelSrc, levelDst in reversed(pyramid):
+        if flow.shape[0:2] != levelSrc.shape:
+            flow = upsample_flow(flow, levelSrc.shape)
+        flow = match_level(levelSrc, levelDst, flow, radius, window)
+        if smooth > 0:
+            for axis in (0, 1):
+                flow[:, :, axis] = box_filter(flow[:, :, axis], smooth)
+    return flow
@@ -0,0 +1,241 @@
+import os
+import sys
+import json
+import time
+import threading
+
+# Stage level profiling for GridMaker runs. Off unless start_profile() is
+# called (GridMaker.py --profile, GridWorker.py --profile); a disabled
+# Stage costs one attribute check.
+#
+#   with Stage("decode", readFile=fileName):
+#       ...
+#
+# Each stage records wall time, CPU time (of its thread where Python can
+# tell, of the whole process otherwise), bytes read and written, and how far
+# it raised the process' peak RSS. Bytes are counted where the I/O happens
+# with add_bytes(), which also covers memory-mapped sheets: TgaImage and
+# cell views count each band a copy touches. The OS only keeps a lifetime high-water
+# mark, so a stage that peaks below an earlier one (or below a previous job
+# in the worker) shows no growth. stop_profile() returns the Profile, which
+# writes a per stage JSON summary and a Chrome trace (chrome://tracing or
+# ui.perfetto.dev) of every stage.
+
+REPORT_VERSION = 2
+
+# Written into every report so the memory numbers aren't misread.
+REPORT_NOTES = {
+    'peakRss': "process high-water mark at the end of the run, including anything before it",
+    'peakRssGrowth': "how far the run raised that high-water mark",
+    'rssGrowth': "per stage: summed rise of the high-water mark while the stage ran; "
+                 "nested and concurrent stages can both count the same growth",
+}
+
+# The Profile recording in this process, None when profiling is off.
+g_profile = None
+
+# .stages: the Stages open on a thread, outermost first.
+g_openStages = threading.local()
+
+
+def cpu_time():
+    if hasattr(time, 'thread_time'):
+        return time.thread_time()
+    times = os.times()
+    return times[0] + times[1]
+
+
+if sys.platform == 'win32':
+    import ctypes
+    from ctypes import wintypes
+
+    class ProcessMemoryCounters(ctypes.Structure):
+        _fields_ = [('cb', wintypes.DWORD), ('PageFaultCount', wintypes.DWORD)] + [
+            (name, ctypes.c_size_t) for name in (
+                'PeakWorkingSetSize', 'WorkingSetSize', 'QuotaPeakPagedPoolUsage', 'QuotaPagedPoolUsage',
+                'QuotaPeakNonPagedPoolUsage', 'QuotaNonPagedPoolUsage', 'PagefileUsage', 'PeakPagefileUsage')]
+
+    def peak_rss():
+        counters = ProcessMemoryCounters()
+        counters.cb = ctypes.sizeof(counters)
+        if not ctypes.windll.psapi.GetProcessMemoryInfo(
+                ctypes.windll.kernel32.GetCurrentProcess(), ctypes.byref(counters), counters.cb):
+            return 0
+        return counters.PeakWorkingSetSize
+else:
+    def peak_rss():
+        # ru_maxrss is in KB on Linux and in bytes on macOS
+        import resource
+        maxRss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return maxRss if sys.platform == 'darwin' else maxRss * 1024
+
+
+class Profile(object):
+    # Stage events of one run; events from pool processes are merged in with
+    # extend(), the trace keeps them apart by pid.
+
+    def __init__(self, title):
+        self.title = title
+        self.pid = os.getpid()
+        self.startTime = time.time()
+        self.startPeakRss = peak_rss()
+        self.endTime = None
+        self.events = []
+        self.threadNames = {}
+        self.lock = threading.Lock()
+
+    def record(self, event):
+        thread = threading.current_thread()
+        with self.lock:
+            self.events.append(event)
+            self.threadNames[(event['pid'], event['tid'])] = thread.name
+
+    def extend(self, events, threadNames=()):
+        with self.lock:
+            self.events.extend(events)
+            self.threadNames.update(threadNames)
+
+    def summary(self):
+        stages = {}
+        for event in self.events:
+            stage = stages.setdefault(event['name'], {
+                'count': 0, 'wallSeconds': 0.0, 'cpuSeconds': 0.0, 'bytesRead': 0, 'bytesWritten': 0, 'rssGrowth': 0})
+            stage['count'] += 1
+            stage['wallSeconds'] += event['wall']
+            stage['cpuSeconds'] += event['cpu']
+            stage['bytesRead'] += event['bytesRead']
+            stage['bytesWritten'] += event['bytesWritten']
+            stage['rssGrowth'] += event['rssGrowth']
+        for stage in stages.values():
+            megabytes = (stage['bytesRead'] + stage['bytesWritten']) / float(1 << 20)
+            stage['mbPerSecond'] = megabytes / stage['wallSeconds'] if stage['wallSeconds'] > 0.0 else 0.0
+
+        endTime = self.endTime or time.time()
+        peakRss = peak_rss()
+        return {
+            'version': REPORT_VERSION,
+            'title': self.title,
+            'wallSeconds': endTime - self.startTime,
+            'peakRss': peakRss,
+            'peakRssGrowth': peakRss - self.startPeakRss,
+            'stages': stages,
+            'notes': REPORT_NOTES,
+        }
+
+    def trace(self):
+        # Chrome trace event format: complete events in microseconds.
+        events = [{'name': event['name'], 'cat': 'gridmaker', 'ph': 'X', 'pid': event['pid'], 'tid': event['tid'],
+                   'ts': int(event['start'] * 1e6), 'dur': int(event['wall'] * 1e6),
+                   'args': dict(event['args'], cpuSeconds=event['cpu'], bytesRead=event['bytesRead'],
+                                bytesWritten=event['bytesWritten'], rssGrowth=event['rssGrowth'])}
+                  for event in self.events]
+        events.extend({'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': tid, 'args': {'name': name}}
+                      for (pid, tid), name in self.threadNames.items())
+        return {'traceEvents': events, 'displayTimeUnit': 'ms', 'otherData': {'title': self.title}}
+
+    def write(self, basePath):
+        # <basePath>.json summary and <basePath>.trace.json; returns the summary
+        summary = self.summary()
+        with open(basePath + ".json", 'w') as f:
+            json.dump(summary, f, indent=1, sort_keys=True)
+        with open(basePath + ".trace.json", 'w') as f:
+            json.dump(self.trace(), f)
+        return summary
+
+
+def active_profile():
+    # A forked pool process inherits the parent's Profile; it doesn't record.
+    profile = g_profile
+    if profile is not None and profile.pid == os.getpid():
+        return profile
+    return None
+
+
+def profiled_call(task):
+    # Pool process side of a profiled job: runs func(job) under its own
+    # Profile and returns the stages with the result, for Profile.extend().
+    func, job = task
+    profile = start_profile()
+    try:
+        return func(job), profile.events, profile.threadNames
+    finally:
+        stop_profile()
+
+
+def start_profile(title=""):
+    global g_profile
+    g_profile = Profile(title)
+    return g_profile
+
+
+def stop_profile():
+    global g_profile
+    profile = active_profile()
+    g_profile = None
+    if profile is not None:
+        profile.endTime = time.time()
+    return profile
+
+
+def add_bytes(bytesRead=0, bytesWritten=0):
+    # Counts bytes in every stage open on this thread; a no-op unless profiling.
+    for stage in getattr(g_openStages, 'stages', ()):
+        stage.add(bytesRead, bytesWritten)
+
+
+def open_stages():
+    return list(getattr(g_openStages, 'stages', ()))
+
+
+def adopt_stages(stages):
+    # A helper thread working for open_stages() of another one counts its
+    # add_bytes() there too.
+    g_openStages.stages = list(stages)
+
+
+class Stage(object):
+    # Context manager timing one stage; add() counts bytes in this stage only,
+    # add_bytes() in it and the stages it is nested in.
+
+    def __init__(self, name, readFile=None, **args):
+        self.name = name
+        self.readFile = readFile
+        self.args = args
+        self.profile = None
+        self.bytesRead = 0
+        self.bytesWritten = 0
+
+    def __enter__(self):
+        if g_profile is not None:
+            self.profile = active_profile()
+        if self.profile is not None:
+            self.startTime = time.time()
+            self.startCpu = cpu_time()
+            self.startPeakRss = peak_rss()
+            if not hasattr(g_openStages, 'stages'):
+                g_openStages.stages = []
+            g_openStages.stages.append(self)
+            if self.readFile is not None:
+                add_bytes(bytesRead=os.path.getsize(self.readFile))
+        return self
+
+    def add(self, bytesRead=0, bytesWritten=0):
+        self.bytesRead += bytesRead
+        self.bytesWritten += bytesWritten
+
+    def __exit__(self, excType, excValue, traceback):
+        if self.profile is None:
+            return
+        g_openStages.stages.remove(self)
+        self.profile.record({
+            'name': self.name,
+            'pid': os.getpid(),
+            'tid': threading.current_thread().ident,
+            'start': self.startTime,
+            'wall': time.time() - self.startTime,
+            'cpu': cpu_time() - self.startCpu,
+            'bytesRead': self.bytesRead,
+            'bytesWritten': self.bytesWritten,
+            'rssGrowth': peak_rss() - self.startPeakRss,
+            'args': self.args,
+        })
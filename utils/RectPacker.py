@@ -0,0 +1,108 @@
+import numpy as np
+
+
+def trim_box(pixels, threshold=0):
+    # (left, top, right, bottom) of the texels whose alpha is above 'threshold',
+    # None for a fully transparent frame. Frames without alpha aren't trimmed.
+    if pixels.ndim != 3 or pixels.shape[2] != 4:
+        return (0, 0, pixels.shape[1], pixels.shape[0])
+
+    opaque = pixels[:, :, 3] > threshold
+    rows = np.flatnonzero(opaque.any(axis=1))
+    if rows.size == 0:
+        return None
+    cols = np.flatnonzero(opaque.any(axis=0))
+    return (int(cols[0]), int(rows[0]), int(cols[-1]) + 1, int(rows[-1]) + 1)
+
+
+def skyline_fit(skyline, index, w, h, width, height):
+    # Lowest y at which a w x h rect starting at skyline[index] fits, or None.
+    x, y, _ = skyline[index]
+    if x + w > width:
+        return None
+    widthLeft = w
+    while widthLeft > 0:
+        if index >= len(skyline):
+            return None
+        y = max(y, skyline[index][1])
+        if y + h > height:
+            return None
+        widthLeft -= skyline[index][2]
+        index += 1
+    return y
+
+
+def skyline_place(skyline, index, x, y, w, h):
+    skyline.insert(index, [x, y + h, w])
+
+    i = index + 1
+    while i < len(skyline):
+        segX, segY, segW = skyline[i]
+        overlap = x + w - segX
+        if overlap <= 0:
+            break
+        if overlap >= segW:
+            del skyline[i]
+            continue
+        skyline[i] = [segX + overlap, segY, segW - overlap]
+        break
+
+    i = 0
+    while i < len(skyline) - 1:
+        if skyline[i][1] == skyline[i + 1][1]:
+            skyline[i][2] += skyline[i + 1][2]
+            del skyline[i + 1]
+        else:
+            i += 1
+
+
+def skyline_pack(sizes, width, height):
+    # Bottom-left skyline packing of (w, h) sizes, tallest first. Returns a
+    # list of (x, y) per size, or None if they don't fit in width x height.
+    positions = [(0, 0)] * len(sizes)
+    order = sorted(range(len(sizes)), key=lambda i: (-sizes[i][1], -sizes[i][0]))
+    skyline = [[0, 0, width]]
+
+    for i in order:
+        w, h = sizes[i]
+        if w == 0 or h == 0:
+            continue
+
+        best = None
+        for index in range(len(skyline)):
+            y = skyline_fit(skyline, index, w, h, width, height)
+            if y is None:
+                continue
+            key = (y + h, skyline[index][2])
+            if best is None or key < best[0]:
+                best = (key, index, y)
+
+        if best is None:
+            return None
+        _, index, y = best
+        x = skyline[index][0]
+        skyline_place(skyline, index, x, y, w, h)
+        positions[i] = (x, y)
+
+    return positions
+
+
+def pack_rects(sizes, padding=1, maxSize=8192):
+    # Packs (w, h) sizes into the smallest power-of-two atlas, trying sizes by
+    # area and then squareness. 'padding' empty texels go right of and below
+    # every rect. Returns ((atlasW, atlasH), [(x, y), ...]).
+    padded = [(w + padding, h + padding) if w and h else (0, 0) for w, h in sizes]
+    area = sum(w * h for w, h in padded)
+    minW = max([w for w, h in padded] + [1])
+    minH = max([h for w, h in padded] + [1])
+
+    powers = [1 << p for p in range(0, 15) if (1 << p) <= maxSize]
+    candidates = [(w, h) for w in powers for h in powers if w >= minW and h >= minH and w * h >= area]
+    candidates.sort(key=lambda s: (s[0] * s[1], abs(s[0] - s[1]), -s[0]))
+
+    for width, height in candidates:
+        positions = skyline_pack(padded, width, height)
+        if positions is not None:
+            return (width, height), positions
+
+    raise ValueError("Rects don't fit in a {0}x{0} atlas".format(maxSize))
@@ -0,0 +1,147 @@
+import os
+import struct
+import numpy as np
+
+from Profiler import add_bytes
+
+HEADER_FORMAT = '<BBBHHBHHHHBB'
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+FOOTER = b"\000" * 8 + b"TRUEVISION-XFILE." + b"\000"
+
+MODES = {1: 'L', 3: 'RGB', 4: 'RGBA'}
+CHANNELS = {'L': 1, 'RGB': 3, 'RGBA': 4}
+
+
+def make_header(size, mode='RGBA'):
+    # Header as PIL writes it: bottom-left origin, alpha bits flagged for RGBA.
+    imageType = 3 if mode == 'L' else 2
+    flags = 8 if mode == 'RGBA' else 0
+    return struct.pack(HEADER_FORMAT, 0, 0, imageType, 0, 0, 0, 0, 0,
+                       size[0], size[1], 8 * CHANNELS[mode], flags)
+
+
+def read_header(fileName):
+    # Parsed header dict, or None if the file is too short to be a TGA.
+    with open(fileName, 'rb') as f:
+        data = f.read(HEADER_SIZE)
+    if len(data) < HEADER_SIZE:
+        return None
+
+    (idLength, colorMapType, imageType, colorMapFirst, colorMapLength, colorMapEntry,
+     xOrigin, yOrigin, width, height, bits, flags) = struct.unpack(HEADER_FORMAT, data)
+
+    return {
+        'imageType': imageType,
+        'colorMapType': colorMapType,
+        'size': (width, height),
+        'bits': bits,
+        'flags': flags,
+        'dataOffset': HEADER_SIZE + idLength + colorMapLength * ((colorMapEntry + 7) // 8),
+    }
+
+
+def is_mappable(fileName, header=None):
+    # Uncompressed 8-bit gray, 24-bit BGR or 32-bit BGRA without a color map.
+    if os.path.splitext(fileName)[1].lower() != '.tga':
+        return False
+    if header is None:
+        header = read_header(fileName)
+    if header is None or header['colorMapType'] != 0:
+        return False
+    if (header['imageType'], header['bits']) not in ((3, 8), (2, 24), (2, 32)):
+        return False
+    width, height = header['size']
+    dataSize = width * height * header['bits'] // 8
+    return dataSize > 0 and os.path.getsize(fileName) >= header['dataOffset'] + dataSize
+
+
+class TgaImage(object):
+    # Memory-mapped uncompressed TGA. 'pixels' is a top-down, left-to-right
+    # view in file channel order (B, G, R[, A]); origin flips are negative
+    # strides and the BGR -> RGB swizzle happens only in read()/write(), on
+    # the region asked for.
+
+    def __init__(self, fileName, header, writable=False):
+        self.fileName = fileName
+        self.size = header['size']
+        self.channels = header['bits'] // 8
+        self.mode = MODES[self.channels]
+
+        shape = (self.size[1], self.size[0], self.channels)
+        self.raw = np.memmap(fileName, np.uint8, 'r+' if writable else 'r', header['dataOffset'], shape)
+
+        pixels = self.raw
+        if not header['flags'] & 0x20:
+            pixels = pixels[::-1]
+        if header['flags'] & 0x10:
+            pixels = pixels[:, ::-1]
+        self.pixels = pixels
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        self.close()
+
+    def region(self, box=None):
+        if box is None:
+            return self.pixels
+        left, top, right, bottom = box
+        return self.pixels[top:bottom, left:right]
+
+    def read(self, box=None):
+        # RGB(A) or 2D gray copy of 'box' (left, top, right, bottom).
+        src = self.region(box)
+        add_bytes(bytesRead=src.nbytes)
+        if self.channels == 1:
+            return src[:, :, 0].copy()
+        out = np.empty(src.shape, np.uint8)
+        out[:, :, 0:3] = src[:, :, 2::-1]
+        if self.channels == 4:
+            out[:, :, 3] = src[:, :, 3]
+        return out
+
+    def write(self, pixels, location=(0, 0)):
+        # Stores RGB(A) or gray 'pixels' with their top-left corner at 'location'.
+        if pixels.ndim == 2:
+            pixels = pixels[:, :, None]
+        left, top = location
+        dst = self.region((left, top, left + pixels.shape[1], top + pixels.shape[0]))
+        add_bytes(bytesWritten=dst.nbytes)
+        if self.channels == 1:
+            dst[:, :, 0] = pixels[:, :, 0]
+            return
+        dst[:, :, 2::-1] = pixels[:, :, 0:3]
+        if self.channels == 4:
+            dst[:, :, 3] = pixels[:, :, 3] if pixels.shape[2] == 4 else 255
+
+    def flush(self):
+        if self.raw is not None and self.raw.mode == 'r+':
+            self.raw.flush()
+
+    def close(self):
+        # Drops this object's references only: the file stays mapped (and on
+        # Windows can't be removed or replaced) while views from region() or
+        # 'pixels' are alive, so callers release theirs first.
+        self.flush()
+        self.raw = None
+        self.pixels = None
+
+
+def open_tga(fileName, writable=False):
+    # TgaImage for a mappable file, None if it has to go through PIL.
+    header = read_header(fileName) if os.path.isfile(fileName) else None
+    if header is None or not is_mappable(fileName, header):
+        return None
+    return TgaImage(fileName, header, writable)
+
+
+def create_tga(fileName, size, mode='RGBA'):
+    # Pre-sized zero-filled TGA with PIL's layout (bottom-left origin, v2
+    # footer), returned mapped for writing.
+    with open(fileName, 'wb') as f:
+        f.write(make_header(size, mode))
+        f.seek(HEADER_SIZE + size[0] * size[1] * CHANNELS[mode])
+        f.write(FOOTER)
+
+    return open_tga(fileName, writable=True)